@@ -2,4 +2,6 @@ import logging
 from . import cli
 
 # logging.basicConfig()
-cli.main()
+# Guarded, since worker processes that aren't forked re-import the main module
+if __name__ == "__main__":
+    cli.main()
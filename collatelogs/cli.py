@@ -5,48 +5,60 @@
 from __future__ import absolute_import, print_function, unicode_literals
 
 import argparse
-from glob import glob
+import fnmatch
+import functools
+import glob
+from itertools import chain
 import logging
 import os
+import re
 import sys
-import warnings
-
-try:
-    from pytz import timezone
-except ImportError:
-    warnings.warn(
-        "pytz not found; timezone conversion will not be possible. That is, if "
-        "a non-local timezone is specified in the config, an error will be raised. "
-        "Consider running this in an environment with dateutil installed"
-    )
-try:
-    from tzlocal import get_localzone
-except ImportError:
-    warnings.warn(
-        "tzlocal not found; timezone conversion will not be possible. That is, if "
-        "a non-local timezone is specified in the config, an error will be raised. "
-        "Consider running this in an environment with dateutil installed"
-    )
 
-from .handlers import TqdmLoggingHandler
-from .logcollator import LogCollator
-from .util import read_config
+from .handlers import HAS_TQDM, TqdmLoggingHandler
+from .util import mark_config_cache_validated, read_config_cached
 
 logger = logging.getLogger(__name__)
 
 
-CONFIG_SEARCH_PATHS = [
-    os.path.realpath(path)
-    for path in [
-        os.path.join(os.path.expanduser("~"), ".cl_config.yaml"),
-        "./config.yaml",
-        os.path.join(os.path.dirname(__file__), "defaults.yaml"),
+@functools.lru_cache(maxsize=1)
+def config_search_paths():
+    """Return the paths that are searched for a config file, in order
+
+    This is computed lazily, since it isn't needed if --config is given"""
+
+    # abspath is used rather than realpath: it is pure string manipulation,
+    # whereas realpath has to resolve every symlink along each path
+    return [
+        os.path.abspath(path)
+        for path in [
+            os.path.join(os.path.expanduser("~"), ".cl_config.yaml"),
+            "./config.yaml",
+            os.path.join(os.path.dirname(__file__), "defaults.yaml"),
+        ]
     ]
-]
+
 
 REQUIRED_CONFIG_FIELDS = ["log_parsing_info", "line_output_format"]
 
-LOCAL_TIMEZONE = get_localzone()
+# The size of the buffer used by write_lines when writing to a non-terminal
+WRITE_BUFFER_SIZE = 1 << 16
+
+# Populated on first call to get_local_timezone()
+_LOCAL_TIMEZONE = None
+
+
+def get_local_timezone():
+    """Return the local timezone, determining it on first call
+
+    Determining the local timezone requires reading the system timezone
+    configuration, so it (and the tzlocal import) is deferred until needed"""
+
+    global _LOCAL_TIMEZONE
+    if _LOCAL_TIMEZONE is None:
+        from tzlocal import get_localzone
+
+        _LOCAL_TIMEZONE = get_localzone()
+    return _LOCAL_TIMEZONE
 
 
 class ConfigFileError(ValueError):
@@ -71,33 +83,43 @@ def check_config(config):
                 "log_parsing_info[{}] does not contain a line_regex key".format(info_index)
             )
 
+        # Compile once here, so that LogCollator doesn't have to
+        try:
+            info["line_regex"] = re.compile(info["line_regex"])
+        except re.error as error:
+            raise ConfigFileError(
+                "log_parsing_info[{}] has an invalid line_regex: {}".format(
+                    info_index, error
+                )
+            )
+
         # if "timestamp_input_timezone" in info or "timestamp_output_timezone" in info:
         #     if "timestamp_input_timezone" in info:
         #         logger.debug(
         #             "Converting timestamp_input_timezone (%s) to timezone object",
         #             info["timestamp_input_timezone"],
         #         )
-        #         info["timestamp_input_timezone"] = timezone(
+        #         info["timestamp_input_timezone"] = get_timezone(
         #             info["timestamp_input_timezone"]
         #         )
         #     else:
         #         logger.debug(
         #             "Converting blank timestamp_input_timezone to local timezone object"
         #         )
-        #         info["timestamp_input_timezone"] = LOCAL_TIMEZONE
+        #         info["timestamp_input_timezone"] = get_local_timezone()
         #     if "timestamp_output_timezone" in info:
         #         logger.debug(
         #             "Converting timestamp_output_timezone (%s) to timezone object",
         #             info["timestamp_output_timezone"],
         #         )
-        #         info["timestamp_output_timezone"] = timezone(
+        #         info["timestamp_output_timezone"] = get_timezone(
         #             info["timestamp_output_timezone"]
         #         )
         #     else:
         #         logger.debug(
         #             "Converting blank timestamp_output_timezone to local timezone object"
         #         )
-        #         info["timestamp_output_timezone"] = LOCAL_TIMEZONE
+        #         info["timestamp_output_timezone"] = get_local_timezone()
 
         #     if info["timestamp_input_timezone"] == info["timestamp_output_timezone"]:
         #         logger.warning(
@@ -109,40 +131,247 @@ def check_config(config):
 
 
 def find_config_file():
-    """Search CONFIG_SEARCH_PATHS until config file is found; open and return it"""
-    for config_path in CONFIG_SEARCH_PATHS:
+    """Search config_search_paths() until config file is found; open and return it
+
+    Return (config, config_path, validated); see read_config_cached"""
+    isfile = os.path.isfile
+    for config_path in config_search_paths():
         logger.debug("Searching for config file at: %s", config_path)
-        try:
-            config = read_config(config_path)
-        except IOError:
-            pass
-        else:
-            logger.debug("Found config file at: %s", config_path)
-            return config, config_path
+        # Probe for existence first; this is much cheaper than failing to open
+        if not isfile(config_path):
+            continue
+
+        config, validated = read_config_cached(config_path)
+        logger.debug("Found config file at: %s", config_path)
+        return config, config_path, validated
 
     raise ValueError("Could not find any config file!")
 
 
+def _scandir_matches(dirname, part, dirs_only):
+    """Yield entries in dirname whose names match the glob component part
+
+    Entry types are taken from the DirEntry objects themselves, which are
+    populated while listing the directory, so no additional stat is needed"""
+
+    match = re.compile(fnmatch.translate(part)).match
+    # As with glob, hidden files are only matched by patterns starting with "."
+    include_hidden = part.startswith(".")
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            for entry in entries:
+                if not include_hidden and entry.name.startswith("."):
+                    continue
+                if dirs_only and not entry.is_dir():
+                    continue
+                if match(entry.name):
+                    yield os.path.join(dirname, entry.name)
+    except OSError:
+        return
+
+
+def _walk(dirname, include_files=False, _ancestors=()):
+    """Yield dirname and all of its non-hidden descendants, recursively
+
+    Descendants that aren't directories are only included if include_files
+    is given. As with glob, symlinked directories are followed -- except into
+    one of their own ancestors, which would otherwise repeat the same files
+    under ever-longer paths"""
+
+    yield dirname
+    ancestors = _ancestors + (dirname,)
+    try:
+        with os.scandir(dirname or os.curdir) as entries:
+            children = [
+                (os.path.join(dirname, entry.name), entry.is_dir(), entry.is_symlink())
+                for entry in entries
+                if not entry.name.startswith(".")
+            ]
+    except OSError:
+        return
+    for path, is_dir, is_symlink in children:
+        if is_dir:
+            # Only symlinks can lead back to an ancestor, so only they are checked
+            if is_symlink and _is_any_of(path, ancestors):
+                continue
+            for descendant in _walk(path, include_files, ancestors):
+                yield descendant
+        elif include_files:
+            yield path
+
+
+def _is_any_of(path, others):
+    """Return True if path is the same file as any of the paths in others"""
+
+    try:
+        stat = os.stat(path)
+        return any(
+            os.path.samestat(stat, os.stat(other or os.curdir)) for other in others
+        )
+    except OSError:
+        return False
+
+
+def fast_iglob(pattern):
+    """Lazily expand the given glob pattern, using os.scandir
+
+    Components without glob characters are joined without listing their
+    directory; "**" matches zero or more directories. As with glob, a
+    trailing separator only matches directories"""
+
+    drive, rest = os.path.splitdrive(pattern)
+    root = drive + os.sep if rest.startswith(os.sep) else drive
+    parts = [part for part in rest.split(os.sep) if part]
+    if not parts:
+        if os.path.lexists(pattern):
+            yield pattern
+        return
+    dirs_only = rest.endswith(os.sep)
+    # glob yields directories matched by a trailing separator with one
+    suffix = os.sep if dirs_only else ""
+
+    dirnames = [root]
+    for part in parts[:-1]:
+        if part == "**":
+            dirnames = [path for dirname in dirnames for path in _walk(dirname)]
+        elif glob.has_magic(part):
+            dirnames = [
+                path
+                for dirname in dirnames
+                for path in _scandir_matches(dirname, part, dirs_only=True)
+            ]
+        else:
+            dirnames = [os.path.join(dirname, part) for dirname in dirnames]
+
+    last = parts[-1]
+    for dirname in dirnames:
+        if last == "**":
+            for path in _walk(dirname, include_files=not dirs_only):
+                if path != dirname:
+                    yield path + suffix
+                elif dirname:
+                    # As in glob, "**" also matches the directory itself
+                    yield os.path.join(dirname, "")
+        elif glob.has_magic(last):
+            for path in _scandir_matches(dirname, last, dirs_only=dirs_only):
+                yield path + suffix
+        else:
+            path = os.path.join(dirname, last)
+            if os.path.isdir(path) if dirs_only else os.path.lexists(path):
+                yield path + suffix
+
+
+def expand_log_paths(patterns):
+    """Expand the given glob patterns into a list of unique, existing paths
+
+    Order is preserved. Patterns without any glob characters are only
+    checked for existence, rather than being run through glob"""
+
+    def iter_matches(pattern):
+        if glob.has_magic(pattern):
+            return fast_iglob(pattern)
+        if os.path.lexists(pattern):
+            return (pattern,)
+        return ()
+
+    # dict.fromkeys dedupes while preserving order
+    return list(dict.fromkeys(chain.from_iterable(map(iter_matches, patterns))))
+
+
+def find_config_arg(argv):
+    """Return the value given for -c/--config in argv, or None if absent
+
+    This is a simple scan of argv, which avoids building an entire
+    ArgumentParser just to extract a single argument. As in argparse, --config
+    may be abbreviated to any prefix that doesn't match another long option"""
+
+    for index, arg in enumerate(argv):
+        if arg == "--":
+            break
+        if arg.startswith("--"):
+            option, has_value, value = arg.partition("=")
+            if not is_config_option_prefix(option):
+                continue
+            if has_value:
+                return value
+        elif arg.startswith("-c"):
+            if arg != "-c":
+                # As in argparse, both -cPATH and -c=PATH are accepted
+                value = arg[2:]
+                return value[1:] if value.startswith("=") else value
+        else:
+            continue
+
+        # The value is the next argument
+        if index + 1 < len(argv):
+            return argv[index + 1]
+        break
+
+    return None
+
+
+def is_config_option_prefix(option):
+    """Return True if argparse would take the long option as --config"""
+
+    # --config is currently the only long option starting with --c; the
+    # result of the scan is double-checked against argparse in parse_args,
+    # though, so this can't silently go wrong if that ever changes
+    return len(option) > len("--") and "--config".startswith(option)
+
+
 def parse_args():
     """Perform argument parsing"""
 
-    # Create a "dummy" parser that _only_ parses out the --config argument.
-    # This is the first stage in the two-stage argument-parsing process
-    _parser = argparse.ArgumentParser(add_help=False)
-    _parser.add_argument("-c", "--config")
-    # Parse only known args here so that the rest can be used below (--config)
-    _args, remaining_args = _parser.parse_known_args()
+    # This is the first stage in the two-stage argument-parsing process: find
+    # the --config argument, if any, so that the config file can be used to
+    # populate the defaults of the "real" parser
+    argv = sys.argv[1:]
+    config, config_path, validated = load_config(find_config_arg(argv))
+
+    # Initialize the "real" parser
+    parser = build_parser(config)
+    parsed_args = parser.parse_args(argv)
+    # If argparse disagrees with the scan of argv about --config (e.g. because
+    # it was bundled with other short options, as in -Pc), then the defaults
+    # came from the wrong config file. Load the right one and parse again
+    if parsed_args.config != config_path:
+        config, config_path, validated = load_config(parsed_args.config)
+        parser = build_parser(config)
+        parsed_args = parser.parse_args(argv)
+
+    # Expand all of the given globs and replace the entry in parsed_args with the expanded version
+    logs = expand_log_paths(parsed_args.logs)
+    if not logs:
+        parser.error(
+            "Either none of the given paths {} exist, or none of them "
+            "contain files!".format(parsed_args.logs)
+        )
+    parsed_args.logs = logs
+
+    return parsed_args, config, validated
+
+
+def load_config(config_path=None):
+    """Load the config at config_path; return it, its path, and whether it
+    has already been validated (see read_config_cached)
+
+    If config_path isn't given, the config search paths are used"""
 
     # If --config has been given, use it
-    if _args.config:
-        config = read_config(_args.config)
+    if config_path:
+        config, validated = read_config_cached(config_path)
     else:
         # Otherwise look through common locations for the config. Error if one isn't found
-        config, config_path = find_config_file()
-        # No config key in the config file, so just set it here
-        config["config"] = config_path
+        config, config_path, validated = find_config_file()
+    # This becomes the default of --config, so that args.config is always the
+    # path of the config that was actually loaded
+    config["config"] = config_path
+    return config, config_path, validated
+
+
+def build_parser(config):
+    """Build the argparse parser, with defaults populated from config"""
 
-    # Initialize the "real" parser
     parser = argparse.ArgumentParser(
         formatter_class=argparse.ArgumentDefaultsHelpFormatter,
         description="A simple log collator. NOTE: Defaults are based on the selected "
@@ -217,7 +446,7 @@ def parse_args():
         metavar="PATH",
         help="The path to the config file. If this is not given, the "
         "following paths will be searched: {}".format(
-            [str(p) for p in CONFIG_SEARCH_PATHS]
+            [str(p) for p in config_search_paths()]
         ),
     )
     parser.add_argument(
@@ -226,29 +455,25 @@ def parse_args():
         action="store_true",
         help="Indicate this if you don't want the progress bar (slightly faster)",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        metavar="N",
+        help="The number of processes used to process log files in parallel. "
+        "Defaults to the number of CPUs. Parallel processing is only used if "
+        "there are multiple files and enough data for it to be worthwhile",
+    )
     parser.add_argument(
         "-v", "--verbose", action="store_true", help="Increase logging verbosity",
     )
 
-    parsed_args = parser.parse_args(remaining_args)
-
-    # Expand all of the given globs and replace the entry in parsed_args with the expanded version
-    logs = []
-    for log in parsed_args.logs:
-        logs.extend(glob(log))
-    if not logs:
-        parser.error(
-            "Either none of the given paths {} exist, or none of them "
-            "contain files!".format(parsed_args.logs)
-        )
-    parsed_args.logs = logs
-
-    return parser.parse_args(), config
+    return parser
 
 
 def execution_overview(args):
     logger.debug("args: %s", args)
-    if logger.level <= logging.INFO:
+    if logger.isEnabledFor(logging.DEBUG):
         logger.debug("--- Begin execution overview ---")
         logger.debug("Parsing log lines based on the following information:")
         for i, info in enumerate(args.log_parsing_info, 1):
@@ -275,16 +500,21 @@ def execution_overview(args):
 def main():
     """Entry point"""
 
-    args, config = parse_args()
+    args, config, validated = parse_args()
     if args.verbose:
         init_logging(logging.DEBUG)
     else:
         init_logging(logging.WARNING)
         sys.tracebacklimit = 0
 
-    # Wait to check the config until here in order to respect --verbose
-    # TODO: FIX
-    check_config(config)
+    # Wait to check the config until here in order to respect --verbose.
+    # Configs loaded from the cache may have already been validated by a
+    # previous run, in which case they don't need to be checked again
+    if validated:
+        logger.debug("Config %s has already been validated", args.config)
+    else:
+        check_config(config)
+        mark_config_cache_validated(args.config)
 
     # Pull out the dict from args object and use it as "the config"
 
@@ -306,6 +536,10 @@ def main():
             }
         ]
 
+    # Import here rather than at the top of the module, so that --help and
+    # argument errors don't pay for importing the collator's dependencies
+    from .logcollator import LogCollator
+
     # Perform log collation
     lines = LogCollator(
         log_paths=args.logs,
@@ -314,6 +548,8 @@ def main():
         log_parsing_info=log_parsing_info,
         bad_line_behavior=args.bad_line_behavior,
         allow_duplicates=args.allow_duplicates,
+        strip_lines=not args.no_strip,
+        jobs=args.jobs,
         # filename_date_regex=args.filename_date_regex,
         # filename_date_format=args.filename_date_format,
     ).collate(show_progress=not args.no_progress)
@@ -323,15 +559,65 @@ def main():
 
     signal(SIGPIPE, SIG_DFL)
 
-    print("\n".join(lines))
+    write_lines(lines)
+
+
+def write_lines(lines, stream=None):
+    """Write each of the given lines to stream (stdout by default)
+
+    Lines are written individually rather than joined, which would require a
+    second copy of the entire output in memory. When not writing to a
+    terminal, lines are encoded into a buffer that is written directly to the
+    underlying file descriptor in large chunks, bypassing the text layer"""
+
+    if stream is None:
+        stream = sys.stdout
+
+    try:
+        fileno = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        fileno = None
+
+    if fileno is None or stream.isatty():
+        write = stream.write
+        for line in lines:
+            write(line)
+            write("\n")
+        return
+
+    stream.flush()
+    encoding = getattr(stream, "encoding", None) or "utf-8"
+    errors = getattr(stream, "errors", None) or "strict"
+    buf = bytearray()
+    for line in lines:
+        buf += line.encode(encoding, errors)
+        buf += b"\n"
+        if len(buf) >= WRITE_BUFFER_SIZE:
+            _write_all(fileno, buf)
+            del buf[:]
+    if buf:
+        _write_all(fileno, buf)
+
+
+def _write_all(fileno, data):
+    """Write all of data to fileno, handling partial writes"""
+
+    view = memoryview(data)
+    while view:
+        written = os.write(fileno, view)
+        view = view[written:]
 
 
 def init_logging(level):
     """Initialize logging"""
     _logger = logging.getLogger("collatelogs")
-    # TODO: Make conditional on whether progress is requested/tqdm exists
-    console_handler = TqdmLoggingHandler(level=level)
-    # console_handler = logging.StreamHandler()
+    # TODO: Make conditional on whether progress is requested
+    if HAS_TQDM:
+        console_handler = TqdmLoggingHandler(level=level)
+    else:
+        # Without tqdm there are no progress bars to write around
+        console_handler = logging.StreamHandler()
+        console_handler.setLevel(level)
     if level == logging.DEBUG:
         console_handler.setFormatter(logging.Formatter("%(levelname)s %(module)s %(message)s"))
     else:
@@ -1,16 +1,28 @@
 import logging
 import sys
-import tqdm
+
+try:
+    from tqdm import tqdm
+
+    # Due to TQDM bug? https://github.com/tqdm/tqdm/issues/481
+    tqdm.monitor_interval = 0
+    HAS_TQDM = True
+except ImportError:
+    tqdm = None
+    HAS_TQDM = False
 
 
 class TqdmLoggingHandler(logging.Handler):
     def __init__(self, level=logging.NOTSET):
         super(self.__class__, self).__init__(level)
+        # Look this up once, rather than for every record. Without tqdm there
+        # are no progress bars to write around
+        self._write = tqdm.write if HAS_TQDM else print
 
     def emit(self, record):
         try:
             msg = self.format(record)
-            tqdm.tqdm.write(msg, file=sys.stderr)
+            self._write(msg, file=sys.stderr)
             # self.flush()
         except (KeyboardInterrupt, SystemExit):
             raise
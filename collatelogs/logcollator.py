@@ -3,13 +3,20 @@
 """Collate a given set of log files"""
 
 from __future__ import absolute_import, print_function, unicode_literals
+from concurrent.futures import ProcessPoolExecutor
 import contextlib
-from datetime import time, datetime, timedelta
+import multiprocessing
+from datetime import time, datetime, timedelta, timezone
+import functools
+import heapq
 import logging
+from itertools import groupby, islice
+from operator import itemgetter
+import os
 import re
+from stat import S_ISREG
 import sys
 import warnings
-from pytz import timezone
 
 try:
     from tzlocal import get_localzone
@@ -33,29 +40,295 @@ except ImportError:
     )
 
 try:
-    from tqdm import tqdm
-
-    # Due to TQDM bug? https://github.com/tqdm/tqdm/issues/481
-    tqdm.monitor_interval = 0
+    # ciso8601 is optional: it's a faster (C) ISO 8601 parser, but
+    # datetime.fromisoformat works nearly as well
+    from ciso8601 import parse_datetime as parse_iso_timestamp
 except ImportError:
-    warnings.warn(
-        "tqdm not found; progress bars will be unavailable. "
-        "Consider running this in an environment with tqdm installed"
-    )
+    parse_iso_timestamp = datetime.fromisoformat
 
+from .handlers import HAS_TQDM, tqdm
 from .metahandlers import all_meta_handlers
 from .util import (
+    compile_line_formatter,
     compile_regexes,
+    make_matcher,
     match_first,
-    check_that_regexes_are_all_supersets_of_format_string,
     debug_regexes_str,
     extract_keywords_from_format_string,
     convert_timezone,
+    get_fixed_utcoffset,
+    get_timezone,
 )
 
+if not HAS_TQDM:
+    warnings.warn(
+        "tqdm not found; progress bars will be unavailable. "
+        "Consider running this in an environment with tqdm installed"
+    )
 
 logger = logging.getLogger(__name__)
 
+# Log files are only processed in parallel if there is at least this much data
+# in total; below it, the cost of starting worker processes and sending the
+# processed lines back to the parent outweighs the benefit
+PARALLEL_MIN_TOTAL_SIZE = 1 << 22
+
+# Worker processes are always started with spawn, which is the default (and
+# the only safe option) on some platforms anyway. This way, they behave the
+# same everywhere -- and, in particular, never rely on state inherited from
+# the parent process
+MP_START_METHOD = "spawn"
+
+# The number of lines read from a log file at a time; progress is updated once
+# per chunk
+PROGRESS_CHUNK_SIZE = 1000
+
+# The size of the buffer used when reading log files
+READ_BUFFER_SIZE = 1 << 16
+
+# The timestamp given to kept bad lines that precede every parsed timestamp in
+# their file; see LogCollator.make_kept_line
+EARLIEST_TIMESTAMP = datetime.min.replace(tzinfo=timezone.utc)
+
+# The LogCollator used by each worker process; see init_worker
+_WORKER_COLLATOR = None
+
+
+def init_worker(collator_kwargs):
+    """Initialize a worker process by creating its own LogCollator
+
+    LogCollator holds closures (e.g. its line matcher and formatter), so it
+    can't be sent to worker processes. Instead, each worker builds an
+    equivalent one from the arguments that the original was created with"""
+
+    global _WORKER_COLLATOR
+    _WORKER_COLLATOR = LogCollator(log_paths=[], **collator_kwargs)
+
+
+def process_log_path_in_worker(log_path):
+    """Process the given log file in a worker process; return its sorted lines"""
+
+    per_file_lines = _WORKER_COLLATOR.process_log_paths([log_path])
+    if not per_file_lines:
+        return None
+    lines = per_file_lines[0]
+    lines.sort(key=_WORKER_COLLATOR.sort_key)
+    return lines
+
+
+def unique_sorted(iterable):
+    """Yield the items of the (sorted!) iterable, omitting duplicates
+
+    Since the items are sorted, duplicates are adjacent to each other, so
+    there's no need to hash them or to keep track of all items seen"""
+
+    return map(itemgetter(0), groupby(iterable))
+
+
+# Log files typically contain many lines with identical timestamps, so parse
+# results are memoized. datetimes are immutable, so sharing them is safe
+@functools.lru_cache(maxsize=8192)
+def strptime_cached(timestamp, timestamp_format):
+    """Memoized datetime.strptime"""
+
+    return datetime.strptime(timestamp, timestamp_format)
+
+
+def _convert_year_short(value):
+    # As in strptime, 69-99 are 1969-1999 and 0-68 are 2000-2068
+    year = int(value)
+    return year + 2000 if year < 69 else year + 1900
+
+
+# The directives that compile_strptime handles itself. Each maps to: the index
+# of its field in the arguments to datetime(), the regex strptime uses for it
+# (see _strptime.TimeRE), and the function that converts its value
+STRPTIME_DIRECTIVES = {
+    "Y": (0, r"\d\d\d\d", int),
+    "y": (0, r"\d\d", _convert_year_short),
+    "m": (1, r"1[0-2]|0[1-9]|[1-9]", int),
+    "d": (2, r"3[01]|[12]\d|0[1-9]|[1-9]| [1-9]", int),
+    "H": (3, r"2[0-3]|[0-1]\d|\d", int),
+    "M": (4, r"[0-5]\d|\d", int),
+    "S": (5, r"6[0-1]|[0-5]\d|\d", int),
+    "f": (6, r"[0-9]{1,6}", lambda value: int(value.ljust(6, "0"))),
+}
+
+# The directives that compile_strftime handles itself, and the f-string
+# expression (in terms of the datetime, dt) that each is replaced by
+STRFTIME_DIRECTIVES = {
+    "Y": "{dt.year}",
+    "y": "{dt.year % 100:02d}",
+    "m": "{dt.month:02d}",
+    "d": "{dt.day:02d}",
+    "H": "{dt.hour:02d}",
+    "M": "{dt.minute:02d}",
+    "S": "{dt.second:02d}",
+    "f": "{dt.microsecond:06d}",
+    "Z": "{dt.tzname() or ''}",
+}
+
+
+def split_time_format(time_format):
+    """Split a strftime/strptime format into literals and directives
+
+    Yield (literal, directive) pairs, one of which is always None; %% is
+    yielded as part of a literal. Raise ValueError if time_format ends with a
+    lone %"""
+
+    literal = []
+    chars = iter(time_format)
+    for char in chars:
+        if char != "%":
+            literal.append(char)
+            continue
+        directive = next(chars, None)
+        if directive is None:
+            raise ValueError(f"Format {time_format!r} ends with a lone %")
+        if directive == "%":
+            literal.append("%")
+            continue
+        if literal:
+            yield "".join(literal), None
+            literal = []
+        yield None, directive
+
+    if literal:
+        yield "".join(literal), None
+
+
+@functools.lru_cache(maxsize=None)
+def compile_strptime(timestamp_format):
+    """Return a function equivalent to datetime.strptime for timestamp_format
+
+    strptime interprets its format every time that it's called, which is very
+    slow. If timestamp_format only contains numeric date/time directives (see
+    STRPTIME_DIRECTIVES), it is instead translated into a regex here, once,
+    and the returned function simply converts the matched fields.
+    Otherwise, the returned function defers to (memoized) strptime"""
+
+    def fallback(timestamp):
+        return strptime_cached(timestamp, timestamp_format)
+
+    pattern = []
+    # Triplets of (datetime() argument index, regex group number, converter)
+    fields = []
+    try:
+        for literal, directive in split_time_format(timestamp_format):
+            if literal:
+                # As in strptime, whitespace matches any amount of whitespace
+                pattern.extend(
+                    r"\s+" if part.isspace() else re.escape(part)
+                    for part in re.split(r"(\s+)", literal)
+                    if part
+                )
+                continue
+            if directive not in STRPTIME_DIRECTIVES:
+                return fallback
+            index, regex, convert = STRPTIME_DIRECTIVES[directive]
+            # strptime doesn't allow a field to be given twice
+            if any(index == field_index for field_index, _, _ in fields):
+                return fallback
+            pattern.append(f"({regex})")
+            fields.append((index, len(fields) + 1, convert))
+    except ValueError:
+        return fallback
+
+    # As in strptime, the entire timestamp must match, ignoring case
+    fullmatch = re.compile("".join(pattern), re.IGNORECASE).fullmatch
+
+    def strptime(timestamp):
+        match = fullmatch(timestamp)
+        if match is None:
+            raise ValueError(
+                f"time data {timestamp!r} does not match format {timestamp_format!r}"
+            )
+
+        # These are the same defaults that strptime uses
+        args = [1900, 1, 1, 0, 0, 0, 0]
+        group = match.group
+        for index, group_number, convert in fields:
+            args[index] = convert(group(group_number))
+        return datetime(*args)
+
+    return strptime
+
+
+@functools.lru_cache(maxsize=None)
+def compile_strftime(timestamp_format):
+    """Return a function equivalent to datetime.strftime for timestamp_format
+
+    In the same manner as compile_line_formatter, if timestamp_format only
+    contains the directives in STRFTIME_DIRECTIVES, it is translated into an
+    f-string here, once. Otherwise, the returned function defers to strftime"""
+
+    def fallback(dt):
+        return dt.strftime(timestamp_format)
+
+    namespace = {}
+    pieces = []
+    try:
+        for literal, directive in split_time_format(timestamp_format):
+            if literal:
+                # Literals are referenced by name, so they never need escaping
+                name = "_literal{}".format(len(namespace))
+                namespace[name] = literal
+                pieces.append("{%s}" % name)
+            elif directive in STRFTIME_DIRECTIVES:
+                pieces.append(STRFTIME_DIRECTIVES[directive])
+            else:
+                return fallback
+    except ValueError:
+        return fallback
+
+    return eval('lambda dt: f"{}"'.format("".join(pieces)), namespace)
+
+
+@functools.lru_cache(maxsize=8192)
+def dateutil_parse_cached(timestamp):
+    """Memoized dateutil.parser.parse"""
+
+    return dp.parse(timestamp)
+
+
+def parse_timestamp_generic(timestamp, parsing_info=None):
+    """Parse the given timestamp, without knowing its format
+
+    dateutil can parse nearly anything, but is very slow since it has to
+    guess at the format of every timestamp. So, the first timestamp parsed for
+    a given parsing_info is checked for ISO 8601 format; if it is, every
+    subsequent timestamp for that parsing_info is parsed with a (much faster)
+    ISO 8601 parser: ciso8601 if available, otherwise datetime.fromisoformat.
+    Timestamps it can't parse, or that don't come with a parsing_info to cache
+    the choice on, go through dateutil"""
+
+    if parsing_info is None:
+        return dateutil_parse_cached(timestamp)
+
+    parser = parsing_info.get("_timestamp_parser", None)
+    if parser is None:
+        try:
+            parsed_timestamp = parse_iso_timestamp(timestamp)
+        except ValueError:
+            parsing_info["_timestamp_parser"] = dateutil_parse_cached
+            return dateutil_parse_cached(timestamp)
+
+        logger.debug(
+            "Timestamp %r is ISO 8601; using fast parser for subsequent lines",
+            timestamp,
+        )
+        parsing_info["_timestamp_parser"] = parse_iso_timestamp
+        return parsed_timestamp
+
+    if parser is not dateutil_parse_cached:
+        try:
+            return parser(timestamp)
+        except ValueError:
+            # Not consistently ISO 8601 after all; stop trying the fast parser
+            parsing_info["_timestamp_parser"] = dateutil_parse_cached
+
+    return dateutil_parse_cached(timestamp)
+
 
 class LogCollator(object):
     def __init__(
@@ -68,7 +341,20 @@ class LogCollator(object):
         allow_duplicates=False,
         subsecond_digits=3,
         strip_lines=True,
+        jobs=None,
     ):
+        # Keep the arguments needed to create an equivalent LogCollator in
+        # worker processes. The given parsing info dicts are never modified
+        # (see below), so they can be sent to them as they are
+        self._worker_kwargs = dict(
+            line_output_format=line_output_format,
+            log_parsing_info=log_parsing_info,
+            timestamp_output_format=timestamp_output_format,
+            bad_line_behavior=bad_line_behavior,
+            allow_duplicates=allow_duplicates,
+            subsecond_digits=subsecond_digits,
+            strip_lines=strip_lines,
+        )
         if not line_output_format.startswith("{timestamp"):
             raise ValueError(r"line_output_format must start with '{timestamp}'")
 
@@ -84,7 +370,6 @@ class LogCollator(object):
                     "and dateutil is not installed!"
                 )
 
-        # TODO: This is being called twice currently; refactor
         line_output_format_keywords = extract_keywords_from_format_string(
             line_output_format
         )
@@ -93,9 +378,12 @@ class LogCollator(object):
             for name, handler in all_meta_handlers.items()
             if name in line_output_format_keywords
         }
-        self.log_parsing_info = log_parsing_info
-        # Precompile all regexes
-        compile_regexes(self.log_parsing_info)
+        # Precompile all regexes. This works on copies of the given parsing info
+        # dicts, so that the things added to them below (some of which can't be
+        # pickled) don't leak into the caller's config
+        self.log_parsing_info = compile_regexes(log_parsing_info)
+        # Match lines against all regexes at once, rather than one at a time
+        self.match_line = make_matcher(self.log_parsing_info, "line_regex")
         regexes = [info["line_regex"] for info in self.log_parsing_info]
         debug_info = debug_regexes_str(
             # TODO: HACK! debug_regexes_str should take a single iterable to check, so we
@@ -106,13 +394,9 @@ class LogCollator(object):
         )
         for line in debug_info:
             logger.error(line)
-        if not check_that_regexes_are_all_supersets_of_format_string(
-            # TODO: HACK! debug_regexes_str should take a single iterable to check, so we
-            # don't have to do this
-            regexes,
-            [*self.meta_handlers.keys(), "name"],
-            line_output_format,
-        ):
+        # There is a debug line for each regex that is missing groups, so there's
+        # no need to check all of the regexes again
+        if debug_info:
             raise ValueError(
                 "Keywords in prefix output format must be a subset of each "
                 "prefix regex's groups! That is, you have included keywords "
@@ -122,19 +406,60 @@ class LogCollator(object):
 
         self.log_paths = log_paths
         self.line_output_format = line_output_format
+        # Parse the format string once per parsing info, rather than for every
+        # line. Each line's fields are then formatted directly from where they
+        # come from, rather than being merged into a dict first
+        for info in self.log_parsing_info:
+            info["_format_line"] = compile_line_formatter(
+                line_output_format,
+                name=info.get("name", None),
+                group_names=info["line_regex"].groupindex.keys(),
+                meta_names=self.meta_handlers.keys(),
+            )
         self.timestamp_output_format = timestamp_output_format
+        if timestamp_output_format:
+            # Interpret the output format once, rather than for every line
+            self.format_timestamp = compile_strftime(timestamp_output_format)
+            # Resolve time zones once, here, rather than for every line. If no
+            # input time zone is given, timestamps are assumed to be UTC
+            for info in self.log_parsing_info:
+                info["_timestamp_input_timezone"] = get_timezone(
+                    info.get("timestamp_input_timezone", None) or "UTC"
+                )
+                output_timezone = info.get("timestamp_output_timezone", None)
+                info["_timestamp_output_timezone"] = (
+                    get_timezone(output_timezone) if output_timezone else None
+                )
+                info["_process_timestamp"] = self.make_timestamp_processor(info)
 
         self.bad_line_behavior = bad_line_behavior
         self.allow_duplicates = allow_duplicates
         self.subsecond_digits = subsecond_digits
         self.strip_lines = strip_lines
+        # The number of worker processes to use; None means one per CPU
+        self.jobs = jobs
+        # If timestamp_output_format is set, each line will be a tuple of the
+        # format (timestamp_dt, line). This is because timestamp_dt can be used
+        # to sort, since it has already been parsed. This can be much more
+        # accurate than an alphabetical sort, depending on the
+        # timestamp_output_format used (e.g. if only years are printed out,
+        # sorting alphabetically work at all). Otherwise do a basic
+        # alphabetical sort (since we haven't parsed timestamps). If
+        # duplicates are to be removed, though, lines with the same timestamp
+        # are sorted by line, too, so that duplicates end up adjacent
+        if timestamp_output_format and allow_duplicates:
+            self.sort_key = itemgetter(0)
+        else:
+            self.sort_key = None
 
     def amend_prefix_no_parse_timestamp(self, line, meta=None, prev_timestamp=None):
-        """Given a line from a log file, insert its filename and return it"""
+        """Given a line from a log file, insert its filename and return it
+
+        Return None if the line doesn't match any of the line regexes"""
         if not meta:
             meta = {}
 
-        parsing_info = match_first(line, self.log_parsing_info, "line_regex")
+        parsing_info, kwargs_from_regex = self.match_line(line)
         # TODO: Broken until we are doing per-file determination of parsing_info
         # if not parsing_info and prev_timestamp:
         #     fixed_line = f"{prev_timestamp}{line}"
@@ -149,26 +474,22 @@ class LogCollator(object):
         #     logger.warning(f"Added timestamp! ({line!r} -> {fixed_line!r}")
 
         if not parsing_info:
-            raise ValueError(
-                "Line {!r} did not match against any of the given regexes!".format(line)
-            )
-        # Can't use keyword expansion here due to Python 2.7 support
-        kwargs_for_format = meta
-        kwargs_from_regex = parsing_info["match"]
-        kwargs_for_format.update(kwargs_from_regex)
-        kwargs_for_format["name"] = parsing_info["name"]
-        reformatted = self.line_output_format.format(**kwargs_for_format)
-
-        print(reformatted)
+            return None
+        reformatted = parsing_info["_format_line"](
+            kwargs_from_regex, meta, kwargs_from_regex["timestamp"]
+        )
+
         return reformatted, kwargs_from_regex
 
-    def parse_timestamp(self, timestamp, timestamp_format, base_datetime=None):
+    def parse_timestamp(
+        self, timestamp, timestamp_format, base_datetime=None, parsing_info=None
+    ):
         # If a timestamp input format is given, use it to parse the prefix timestamp
         if timestamp_format:
-            parsed_timestamp = datetime.strptime(timestamp, timestamp_format)
-        # Otherwise, use dateutil to generically parse the timestamp
+            parsed_timestamp = compile_strptime(timestamp_format)(timestamp)
+        # Otherwise, parse the timestamp generically
         else:
-            parsed_timestamp = dp.parse(timestamp)
+            parsed_timestamp = parse_timestamp_generic(timestamp, parsing_info)
 
         if base_datetime and parsed_timestamp.year == 1900:
             parsed_timestamp = datetime(
@@ -186,79 +507,99 @@ class LogCollator(object):
 
         return parsed_timestamp
 
-    def amend_prefix_parse_timestamp(
-        self, line, meta=None, filename_date=None, previous_line_date=None
-    ):
-        """Given a line from a log file, insert its filename and return it"""
-        if not meta:
-            meta = {}
+    def make_timestamp_processor(self, parsing_info):
+        """Return a function that fully processes timestamps for parsing_info
+
+        That is, one that parses a timestamp string, adds time zone info (or
+        converts it between time zones), and fixes wrap-around. Everything
+        that is invariant for a given parsing_info is decided once, here,
+        rather than for every line"""
+
+        parse_timestamp = self.parse_timestamp
+        timestamp_format = parsing_info.get("timestamp_input_format", None)
+        timestamp_input_timezone = parsing_info["_timestamp_input_timezone"]
+        timestamp_output_timezone = parsing_info["_timestamp_output_timezone"]
+        fix_wraparound = parsing_info.get("fix_wraparound", False) is True
+
+        # Zones with fixed offsets (very commonly UTC) have no DST to account
+        # for, so they can simply be attached to datetimes, and converting
+        # between two of them is simply a shift by the difference in offsets.
+        # Both are much cheaper than localizing and converting
+        input_utcoffset = get_fixed_utcoffset(timestamp_input_timezone)
+        output_utcoffset = (
+            get_fixed_utcoffset(timestamp_output_timezone)
+            if timestamp_output_timezone
+            else None
+        )
 
-        # A single parsing info dict (i.e. one regex and its associated data)
-        parsing_info = match_first(line, self.log_parsing_info, "line_regex")
-        if not parsing_info:
-            # TODO: Add to config! Broken until then
-            # if previous_line_date:
-            #     prev_ts = previous_line_date.strftime("%H:%M:%S")
-            #     fixed_line = f"[{prev_ts}] {line}"
-            #     parsing_info = match_first(
-            #         fixed_line, self.log_parsing_info, "line_regex"
-            #     )
-            if not parsing_info:
-                raise ValueError(
-                    "Line {!r} did not match against any of the given regexes!".format(
-                        line
+        # If timestamp_output_timezone is given, the user wants to convert time zone
+        if timestamp_output_timezone:
+            if input_utcoffset is not None and output_utcoffset is not None:
+                offset_change = output_utcoffset - input_utcoffset
+
+                def add_timezone(dt):
+                    return (dt + offset_change).replace(
+                        tzinfo=timestamp_output_timezone
                     )
-                )
 
-        # Can't use keyword expansion here due to Python 2.7 support
-        kwargs_for_format = meta
-        kwargs_from_regex = parsing_info["match"]
-        kwargs_for_format.update(kwargs_from_regex)
-        # If a timestamp output format is given, use it to reformat timestamp output
-        if self.timestamp_output_format:
-            parsed_timestamp = self.parse_timestamp(
-                timestamp=kwargs_for_format["timestamp"],
-                timestamp_format=parsing_info.get("timestamp_input_format", None),
-                base_datetime=(
-                    previous_line_date if previous_line_date else filename_date
-                ),
-            )
+            else:
 
-            # If parsed_timestamp is naive...
-            if not getattr(parsed_timestamp, "tzinfo", None):
-                timestamp_input_timezone = parsing_info.get(
-                    "timestamp_input_timezone", None
-                )
-                timestamp_output_timezone = parsing_info.get(
-                    "timestamp_output_timezone", None
-                )
-                # If either timestamp_input_timezone or timestamp_output_timezone
-                # is given, the user wants to convert time zone
-                if timestamp_output_timezone:
-                    parsed_timestamp = convert_timezone(
-                        dt=parsed_timestamp,
+                def add_timezone(dt):
+                    return convert_timezone(
+                        dt=dt,
                         tz_from=timestamp_input_timezone,
                         tz_to=timestamp_output_timezone,
                     )
-                # If they don't want to convert, then we simply localize (i.e. add timezone info
-                # without changing the time)
-                else:
-                    if timestamp_input_timezone:
-                        parsed_timestamp = timezone(timestamp_input_timezone).localize(
-                            parsed_timestamp
-                        )
-                    else:
-                        parsed_timestamp = timezone("UTC").localize(parsed_timestamp)
 
+        # If they don't want to convert, then we simply localize (i.e. add timezone info
+        # without changing the time)
+        elif input_utcoffset is not None:
+
+            def add_timezone(dt):
+                return dt.replace(tzinfo=timestamp_input_timezone)
+
+        else:
+            add_timezone = timestamp_input_timezone.localize
+
+        # Consecutive lines very often have identical timestamps, so the most
+        # recently processed timestamp string is kept along with the result of
+        # parsing it and adding its time zone (which is by far the costliest
+        # part). Timestamps without a year are completed from base_datetime,
+        # in which case that must be the same, too
+        uses_base_datetime = bool(timestamp_format) and not (
+            "%Y" in timestamp_format or "%y" in timestamp_format
+        )
+        last_timestamp = last_base_datetime = last_parsed_timestamp = None
+
+        def process_timestamp(timestamp, base_datetime=None, previous_line_date=None):
+            nonlocal last_timestamp, last_base_datetime, last_parsed_timestamp
+
+            if timestamp == last_timestamp and (
+                not uses_base_datetime or base_datetime == last_base_datetime
+            ):
+                parsed_timestamp = last_parsed_timestamp
             else:
-                logger.info(
-                    "Timestamp {} already has timezone data; skipping further translation".format(
-                        parsed_timestamp
-                    )
+                parsed_timestamp = parse_timestamp(
+                    timestamp=timestamp,
+                    timestamp_format=timestamp_format,
+                    parsing_info=parsing_info,
+                    base_datetime=base_datetime,
                 )
 
+                # If parsed_timestamp is naive...
+                if not parsed_timestamp.tzinfo:
+                    parsed_timestamp = add_timezone(parsed_timestamp)
+                else:
+                    logger.info(
+                        "Timestamp %s already has timezone data; skipping further translation",
+                        parsed_timestamp,
+                    )
+                last_timestamp = timestamp
+                last_base_datetime = base_datetime
+                last_parsed_timestamp = parsed_timestamp
+
             if (
-                parsing_info.get("fix_wraparound", False) is True
+                fix_wraparound
                 and previous_line_date
                 and parsed_timestamp < previous_line_date
             ):
@@ -268,40 +609,71 @@ class LogCollator(object):
                     f"Wrap-around detected! Advanced {old_parsed_timestamp} "
                     f"1 day to {parsed_timestamp}"
                 )
-            kwargs_for_format["timestamp"] = parsed_timestamp.strftime(
-                self.timestamp_output_format
-            )
 
-        kwargs_for_format["name"] = parsing_info["name"]
-        reformatted = self.line_output_format.format(**kwargs_for_format)
-        # if self.strip_lines:
-        #     reformatted = reformatted.strip()
-        return (parsed_timestamp, reformatted)
+            return parsed_timestamp
+
+        return process_timestamp
 
-    def process_log_line_no_parse_timestamp(
-        self, line, path_meta_keywords, prev_timestamp_str
+    def amend_prefix_parse_timestamp(
+        self, line, meta=None, filename_date=None, previous_line_date=None
     ):
-        # Split into two funcs
-        amended_line, timestamp_str = self.amend_prefix_no_parse_timestamp(
-            line, meta=path_meta_keywords, prev_timestamp=prev_timestamp_str,
-        )
+        """Given a line from a log file, insert its filename and return it
 
-        return amended_line, timestamp_str
+        Return None if the line doesn't match any of the line regexes"""
+        if not meta:
+            meta = {}
 
-    def process_log_line_parse_timestamp(
-        self, line, filename_date, previous_line_date, path_meta_keywords
-    ):
-        previous_line_date, amended_line = self.amend_prefix_parse_timestamp(
-            line,
-            filename_date=filename_date,
-            meta=path_meta_keywords,
-            previous_line_date=previous_line_date,
-        )
+        # A single parsing info dict (i.e. one regex and its associated data)
+        parsing_info, kwargs_from_regex = self.match_line(line)
+        if not parsing_info:
+            # TODO: Add to config! Broken until then
+            # if previous_line_date:
+            #     prev_ts = previous_line_date.strftime("%H:%M:%S")
+            #     fixed_line = f"[{prev_ts}] {line}"
+            #     parsing_info = match_first(
+            #         fixed_line, self.log_parsing_info, "line_regex"
+            #     )
+            if not parsing_info:
+                return None
 
-        return amended_line, previous_line_date
+        # If a timestamp output format is given, use it to reformat timestamp output
+        if self.timestamp_output_format:
+            parsed_timestamp = parsing_info["_process_timestamp"](
+                kwargs_from_regex["timestamp"],
+                base_datetime=(
+                    previous_line_date if previous_line_date else filename_date
+                ),
+                previous_line_date=previous_line_date,
+            )
+            timestamp = self.format_timestamp(parsed_timestamp)
+        else:
+            timestamp = kwargs_from_regex["timestamp"]
+
+        reformatted = parsing_info["_format_line"](kwargs_from_regex, meta, timestamp)
+        return (parsed_timestamp, reformatted)
 
-    def process_log_file(self, log_path, log_lines, progress=None):
-        processed_lines = []
+    def process_log_file(
+        self,
+        log_path,
+        log_lines,
+        progress=None,
+        processed_lines=None,
+        encoding="utf-8",
+    ):
+        """Process the lines of the given log file
+
+        Processed lines are added to processed_lines, which may be either a
+        list or a set (in order to remove duplicates as they are found), and
+        returned. If it isn't given, a new list is created. Progress is
+        counted in bytes, using the encoding that the file was read with; for
+        it to be exact, line endings must not have been translated"""
+
+        if processed_lines is None:
+            processed_lines = []
+        if isinstance(processed_lines, set):
+            add_processed_line = processed_lines.add
+        else:
+            add_processed_line = processed_lines.append
         # Call all meta handlers and map returned values to keywords
         # These will be used downstream to populate the line_output_format
         # Note that this might be empty -- it depends on whether meta
@@ -309,146 +681,277 @@ class LogCollator(object):
         path_meta_keywords = {
             key: handler(log_path) for key, handler in self.meta_handlers.items()
         }
-        parsing_info = match_first(
+        parsing_info, match = match_first(
             log_path, self.log_parsing_info, "filename_date_regex"
         )
         if parsing_info:
-            filename_date_regex = parsing_info["filename_date_regex"]
             try:
                 filename_date_format = parsing_info["filename_date_format"]
             except KeyError:
                 raise ValueError(
                     "If filename_date_regex is given, filename_date_format must also be given in config!"
                 )
-            match = re.match(filename_date_regex, log_path)
-            if match:
-                filename_date_str = match.groupdict()["date"]
-            else:
-                raise ValueError(
-                    f"Failed to parse file path {log_path!r} with regex {filename_date_regex}"
-                )
-            filename_date = datetime.strptime(filename_date_str, filename_date_format)
+            # Use the match from above, rather than matching the path again
+            filename_date_str = match.group("date")
+            filename_date = compile_strptime(filename_date_format)(filename_date_str)
             logger.debug(f"Parsed date {filename_date} from path {log_path}")
         else:
             filename_date = None
 
         previous_line_date = None
-        previous_timestamp_str = None
-        # Amend all lines
-        for line_number, line in enumerate(log_lines):
-            if self.strip_lines:
-                line = line.strip()
-
-            if not line:
-                continue
+        # Bind these to locals, since they are used for every line
+        strip_lines = self.strip_lines
+        parse_timestamps = bool(self.timestamp_output_format)
+        amend_prefix_parse_timestamp = self.amend_prefix_parse_timestamp
+        amend_prefix_no_parse_timestamp = self.amend_prefix_no_parse_timestamp
+        handle_bad_line = self.handle_bad_line
+        make_kept_line = self.make_kept_line
+        log_lines = iter(log_lines)
+        # Lines skipped with bad_line_behavior "warn"; see below
+        skipped_lines = []
+        # Amend all lines. Lines are read in chunks so that progress can be
+        # updated once per chunk, rather than checked for every line
+        for chunk in iter(lambda: list(islice(log_lines, PROGRESS_CHUNK_SIZE)), []):
+            # Progress is in bytes (as is its total), not characters
+            if progress is not None:
+                chunk_size = len("".join(chunk).encode(encoding))
+            # Strip the whole chunk at once, rather than checking for every
+            # line. Even if lines aren't to be stripped, the line endings are
+            # still removed
+            if strip_lines:
+                chunk = map(str.strip, chunk)
+            else:
+                chunk = [line.rstrip("\r\n") for line in chunk]
+            for line in chunk:
+                if not line:
+                    continue
 
-            try:
-                if self.timestamp_output_format:
-                    processed_line, timestamp = self.process_log_line_parse_timestamp(
-                        line=line,
-                        filename_date=filename_date,
-                        previous_line_date=previous_line_date,
-                        path_meta_keywords=path_meta_keywords,
-                    )
-                    previous_line_date = timestamp
-                    processed_lines.append((timestamp, processed_line))
-                else:
-                    (
-                        processed_line,
-                        timestamp_str,
-                    ) = self.process_log_line_no_parse_timestamp(
-                        line=line,
-                        path_meta_keywords=path_meta_keywords,
-                        prev_timestamp_str=previous_timestamp_str,
-                    )
-                    processed_lines.append(processed_line)
-                    previous_timestamp_str = timestamp_str
-            except dp._parser.ParserError as error:
-                tqdm.write(f"{error}")
-            except ValueError:
-                if self.bad_line_behavior == "keep":
-                    processed_line = line
-                elif self.bad_line_behavior == "error":
-                    logger.error(f"Invalid line: {line}")
-                    raise
-                elif self.bad_line_behavior == "warn":
-                    logger.warning("No match found; skipped: %r", line)
-                elif self.bad_line_behavior == "discard":
-                    # Discard
-                    pass
+                try:
+                    # The amend methods are called directly, with positional
+                    # arguments, since this is done for every line
+                    if parse_timestamps:
+                        # This is (timestamp, processed_line)
+                        processed_line = amend_prefix_parse_timestamp(
+                            line, path_meta_keywords, filename_date, previous_line_date
+                        )
+                        if processed_line is not None:
+                            previous_line_date = processed_line[0]
+                    else:
+                        amended = amend_prefix_no_parse_timestamp(
+                            line, path_meta_keywords
+                        )
+                        processed_line = amended[0] if amended else None
+                except ValueError as error:
+                    # e.g. a timestamp that doesn't match timestamp_input_format,
+                    # or that dateutil can't parse (its ParserError is a
+                    # ValueError)
+                    if handle_bad_line(line, skipped_lines, error):
+                        add_processed_line(make_kept_line(line, previous_line_date))
+                    continue
+
+                # Lines that don't match any regex are common enough (e.g.
+                # multi-line messages) that they are signaled by None, rather
+                # than by raising (and catching) an exception
+                if processed_line is None:
+                    if handle_bad_line(line, skipped_lines):
+                        add_processed_line(make_kept_line(line, previous_line_date))
                 else:
-                    raise AssertionError(
-                        f"Invalid bad_line_behavior {self.bad_line_behavior}; "
-                        "this shouldn't be possible"
-                    )
+                    add_processed_line(processed_line)
+
+            if progress is not None:
+                progress.update(chunk_size)
 
-            # line_number is only used to enforce the update_interval
-            if progress and line_number % 100 == 0:
-                progress.update(100)
+        # Skipped lines are only warned about once the whole file has been
+        # read, since it is read again from the start if it turns out not to
+        # be UTF-8 (see process_log_paths)
+        for line in skipped_lines:
+            logger.warning("No match found; skipped: %r", line)
 
         return processed_lines
 
-    def process_path_map(self, path_map, progress=None):
-        """Process lines in path_map based on other keys"""
-        # TODO: VERY BROKEN
-        # filename_date_format = self.log_parsing_info[-1]["filename_date_format"]
-        all_processed_lines = []
-        for log_path, log_lines in path_map.items():
-            processed_lines = self.process_log_file(
-                log_path, log_lines, progress=progress,
+    def handle_bad_line(self, line, skipped_lines, error=None):
+        """Handle a line that couldn't be processed, per bad_line_behavior
+
+        error is the exception raised while processing the line, if any;
+        otherwise, the line didn't match any of the line regexes. Lines that
+        are to be warned about are added to skipped_lines. Return True if the
+        line is to be kept (see make_kept_line)"""
+
+        if self.bad_line_behavior == "keep":
+            return True
+        elif self.bad_line_behavior == "error":
+            logger.error(f"Invalid line: {line}")
+            if error is None:
+                error = ValueError(
+                    "Line {!r} did not match against any of the given regexes!".format(
+                        line
+                    )
+                )
+            raise error
+        elif self.bad_line_behavior == "warn":
+            skipped_lines.append(line)
+        elif self.bad_line_behavior == "discard":
+            # Discard
+            pass
+        else:
+            raise AssertionError(
+                f"Invalid bad_line_behavior {self.bad_line_behavior}; "
+                "this shouldn't be possible"
             )
-            all_processed_lines.extend(processed_lines)
+        return False
 
-        return all_processed_lines
+    def make_kept_line(self, line, previous_line_date=None):
+        """Return the processed form of a bad line that is to be kept as is
 
-    def collate(self, show_progress=True):
-        """Collate log paths"""
+        If timestamps are parsed, the line is placed at the previous line's
+        timestamp -- or, if there isn't one yet, before all other lines.
+        Otherwise, it is simply sorted along with all other lines"""
 
-        # A map of log paths to their lines
-        path_map = {}
-        # Populate path map --
-        for log_path in self.log_paths:
-            path_map[log_path] = {}
+        if self.timestamp_output_format:
+            return (previous_line_date or EARLIEST_TIMESTAMP, line)
+        return line
+
+    def process_log_paths(self, log_paths, progress=None):
+        """Process the given log files; return a list of processed lines per file
+
+        Each file is streamed through process_log_file line by line, rather
+        than being read into memory in its entirety first"""
+
+        all_processed_lines = []
+        for log_path in log_paths:
+            progress_before = progress.n if progress is not None else 0
+            # Line endings aren't translated (newline=""), so that progress
+            # can be counted exactly; they are removed along with any other
+            # trailing whitespace anyway
             try:
-                with open(log_path) as log_file:
-                    path_map[log_path] = log_file.readlines()
+                with open(
+                    log_path,
+                    encoding="utf-8",
+                    newline="",
+                    buffering=READ_BUFFER_SIZE,
+                ) as log_file:
+                    processed_lines = self.process_log_file(
+                        log_path, log_file, progress=progress, encoding="utf-8"
+                    )
             except IOError:
                 logger.warning("Could not read file %s", log_path)
+                continue
             except UnicodeDecodeError:
                 # TODO: Allow this to be specified in config somehow
+                # Start over, discarding any lines processed (and undoing any
+                # progress made) before the error
+                if progress is not None:
+                    progress.update(progress_before - progress.n)
                 try:
-                    with open(log_path, encoding="LATIN1") as log_file:
-                        path_map[log_path] = log_file.readlines()
+                    with open(
+                        log_path,
+                        encoding="LATIN1",
+                        newline="",
+                        buffering=READ_BUFFER_SIZE,
+                    ) as log_file:
+                        processed_lines = self.process_log_file(
+                            log_path, log_file, progress=progress, encoding="LATIN1"
+                        )
                 except IOError:
                     logger.warning("Could not read file %s", log_path)
+                    continue
 
-        # Determine sum of total lines in all log files
-        total_lines = sum([len(lines) for lines in path_map.values()])
-        # Bail if there are no lines to process
-        if not total_lines:
-            logger.warning("No lines to process!")
-            return []
+            all_processed_lines.append(processed_lines)
 
-        if "tqdm" in sys.modules and show_progress:
+        return all_processed_lines
+
+    def process_log_paths_parallel(self, log_paths, jobs, progress=None):
+        """Process the given log files in parallel; return a list of sorted
+        lines per file
+
+        Each file is processed (and sorted) in its own worker process.
+        Progress is updated as each file completes"""
+
+        chunksize = max(1, len(log_paths) // (jobs * 4))
+        all_processed_lines = []
+        with ProcessPoolExecutor(
+            max_workers=jobs,
+            mp_context=multiprocessing.get_context(MP_START_METHOD),
+            initializer=init_worker,
+            initargs=(self._worker_kwargs,),
+        ) as executor:
+            results = executor.map(
+                process_log_path_in_worker, log_paths, chunksize=chunksize
+            )
+            for log_path, processed_lines in zip(log_paths, results):
+                if progress is not None:
+                    with contextlib.suppress(OSError):
+                        progress.update(os.path.getsize(log_path))
+                if processed_lines is not None:
+                    all_processed_lines.append(processed_lines)
+
+        return all_processed_lines
+
+    def collate(self, show_progress=True):
+        """Collate log paths; return an iterator of the collated lines"""
+
+        # Determine the total size of all log files; this is used to track
+        # progress, since the number of lines isn't known until they are read.
+        # Only regular files have a meaningful size, though: e.g. pipes
+        # (including process substitution) and /proc files report 0. If any
+        # are given, the total is unknown (None)
+        total_size = 0
+        for log_path in self.log_paths:
+            try:
+                stat = os.stat(log_path)
+            except OSError:
+                # This is reported when the file fails to open
+                continue
+            if not S_ISREG(stat.st_mode):
+                total_size = None
+                break
+            total_size += stat.st_size
+
+        # Processing is CPU-bound, so files are processed in separate processes
+        # rather than threads -- but only if there is enough work to be worth
+        # it. Files that aren't regular files are always read here, since they
+        # can generally only be read once, and only by this process
+        jobs = min(self.jobs or os.cpu_count() or 1, len(self.log_paths))
+        parallel = (
+            jobs > 1
+            and total_size is not None
+            and total_size >= PARALLEL_MIN_TOTAL_SIZE
+        )
+
+        sort_key = self.sort_key
+        if HAS_TQDM and show_progress:
             # Show progress bars if possible and requested...
-            with tqdm(total=total_lines, unit="lines") as progress:
-                log_lines = self.process_path_map(path_map, progress)
+            # Without a total, tqdm simply counts up
+            progress = tqdm(total=total_size or None, unit="B", unit_scale=True)
         else:
             # ...otherwise don't
-            log_lines = self.process_path_map(path_map)
+            progress = None
+
+        with progress if progress is not None else contextlib.nullcontext():
+            if parallel:
+                # Workers sort each file's lines themselves
+                per_file_lines = self.process_log_paths_parallel(
+                    self.log_paths, jobs, progress
+                )
+            else:
+                per_file_lines = self.process_log_paths(self.log_paths, progress)
+                # Each file's lines are almost always already in order, in
+                # which case sorting them is linear
+                for lines in per_file_lines:
+                    lines.sort(key=sort_key)
+
+        # Bail if there are no lines to process
+        if not any(per_file_lines):
+            logger.warning("No lines to process!")
+            return iter([])
+
+        # Rather than sorting all lines together, the sorted files are merged
+        log_lines = heapq.merge(*per_file_lines, key=sort_key)
 
         # Remove duplicates if requested
         if not self.allow_duplicates:
-            log_lines = set(log_lines)
-
-        # If timestamp_output_format is set, log_lines will be a list
-        # of tuples of the format (timestamp_dt, line). This is because
-        # timestamp_dt can be used to sort, since it has already been parsed.
-        # This can be much more accurate than an alphabetical sort, depending
-        # on the timestamp_output_format used (e.g. if only years are printed
-        # out, sorting alphabetically work at all)
+            log_lines = unique_sorted(log_lines)
+
         if self.timestamp_output_format:
-            return [line[1] for line in sorted(log_lines, key=lambda x: x[0])]
-        # Otherwise to a basic alphabetical sort (since we haven't parsed
-        # timestamps)
-        return sorted(log_lines)
+            return (line for _, line in log_lines)
+        return log_lines
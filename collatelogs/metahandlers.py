@@ -4,6 +4,7 @@
 
 These are used to populated keywords in the line_output_format, elsewhere"""
 
+import functools
 import os
 
 try:
@@ -15,19 +16,43 @@ except ImportError:
 import sys
 
 
+@functools.lru_cache(maxsize=None)
+def get_username_from_uid(uid):
+    """Get the username of the given user ID
+
+    Log files are typically owned by only a few users, so the (potentially
+    slow, e.g. if it goes over the network) user database lookup is done
+    once per user, rather than once per file"""
+
+    return pwd.getpwuid(uid).pw_name
+
+
+@functools.lru_cache(maxsize=None)
+def get_username_from_sid_string(sid_string):
+    """Get the username of the given (string form of a) Windows SID
+
+    As with get_username_from_uid, this is memoized: the account lookup may
+    have to query a domain controller. SIDs are cached by their string form,
+    since that is guaranteed to be hashable"""
+
+    username, _, _ = win32security.LookupAccountSid(
+        None, win32security.ConvertStringSidToSid(sid_string)
+    )
+    return username
+
+
 def get_owner_from_path(path):
     """Get the username of the owner of the given file"""
 
     if "pwd" in sys.modules:
         # On unix
-        return pwd.getpwuid(os.stat(path).st_uid).pw_name
+        return get_username_from_uid(os.stat(path).st_uid)
 
     # On Windows
     f = win32security.GetFileSecurity(path, win32security.OWNER_SECURITY_INFORMATION)
-    username, _, _ = win32security.LookupAccountSid(
-        None, f.GetSecurityDescriptorOwner()
+    return get_username_from_sid_string(
+        win32security.ConvertSidToStringSid(f.GetSecurityDescriptorOwner())
     )
-    return username
 
 
 # All available meta handlers
@@ -4,21 +4,39 @@
 
 from __future__ import absolute_import, print_function, unicode_literals
 
+import functools
+import hashlib
+import json
 import logging
+import os
 import re
+import tempfile
 from string import Formatter
 
 import yaml
 
+try:
+    # Use the libyaml-backed loader when available; it is much faster
+    from yaml import CSafeLoader as _Loader
+except ImportError:
+    from yaml import SafeLoader as _Loader
+
+try:
+    # Python 3.11+
+    from re import _parser as sre_parse
+except ImportError:
+    import sre_parse
+
 
 logger = logging.getLogger(__name__)
 formatter = Formatter()
 
+# The type of a compiled regex
+Pattern = type(re.compile(""))
+
 
 def check_that_regexes_are_all_supersets_of_format_string(regexes, meta, format_string):
-    return all(
-        [not get_missing_groups(regex, meta, format_string) for regex in regexes]
-    )
+    return all(not get_missing_groups(regex, meta, format_string) for regex in regexes)
 
 
 def debug_regexes(regexes, meta, format_string):
@@ -45,56 +63,551 @@ def get_missing_groups(regex, meta, format_string):
     format_string_keywords = extract_keywords_from_format_string(format_string)
     # logger.debug("Got format string keywords: %s", format_string_keywords)
     # Determine which groups exist in the regex
-    regex_groups = extract_groups_from_compiled_regex(regex)
+    regex_groups = regex.groupindex
 
     # logger.debug("Got regex groups: %s", regex_groups)
     # logger.debug("meta keywords: %s", meta)
     # Determine whether all format keywords exist in the regex as groups
     # foo =  set(regex_groups).union(set(meta)).issuperset(format_string_keywords)
-    missing = set(format_string_keywords).difference(set(regex_groups).union(set(meta)))
+    missing = set(format_string_keywords.difference(regex_groups, meta))
     return missing
 
 
+@functools.lru_cache(maxsize=32)
 def extract_keywords_from_format_string(format_string):
-    """Determine which keywords exist in given format string"""
+    """Determine which keywords exist in given format string
 
-    return [keyword for _, keyword, _, _ in formatter.parse(format_string)]
+    These are returned as a frozenset, since this is memoized (the same
+    format string is checked against every regex)"""
+
+    return frozenset(
+        keyword
+        for _, keyword, _, _ in formatter.parse(format_string)
+        # Literal text after the last field has no keyword
+        if keyword is not None
+    )
 
 
-def extract_groups_from_compiled_regex(regex):
-    """Determine which groups exist in given (compiled!) regex"""
+def translate_format_string(format_string, field_source):
+    """Translate a "new style" format string into the source of an f-string
+
+    field_source is called with each field name, and returns the source of
+    the expression that the field's value comes from. Return (source,
+    namespace), where namespace holds the literals and format specs that
+    source refers to, or None if format_string uses features that can't be
+    translated (positional or nested fields, attribute or index access)"""
+
+    namespace = {}
+    pieces = []
+    for literal, field_name, format_spec, conversion in formatter.parse(format_string):
+        if literal:
+            # Literals are referenced by name, so they never need escaping
+            name = "_literal{}".format(len(namespace))
+            namespace[name] = literal
+            pieces.append("{%s}" % name)
+        if field_name is None:
+            continue
+        if not field_name.isidentifier() or "{" in (format_spec or ""):
+            return None
+
+        piece = field_source(field_name)
+        if conversion:
+            piece += "!" + conversion
+        if format_spec:
+            name = "_spec{}".format(len(namespace))
+            namespace[name] = format_spec
+            piece += ":{%s}" % name
+        pieces.append("{%s}" % piece)
+
+    return 'f"{}"'.format("".join(pieces)), namespace
+
+
+def compile_line_formatter(format_string, name, group_names, meta_names):
+    """Compile the line output format for a single set of parsing info
+
+    The returned function takes (groups, meta, timestamp): the named groups
+    of the line regex's match, the meta keywords of the log file, and the
+    timestamp to output. It is equivalent to format_string.format() with all
+    of them merged into a single dict (in which the groups take precedence
+    over the meta keywords), but no such dict is built, and the format string
+    is parsed only once: it is translated into an f-string in which each
+    field is looked up directly from its source. name is constant, so it is
+    built in. Format strings that can't be translated fall back to
+    str.format"""
+
+    def field_source(field_name):
+        if field_name == "name":
+            return "_name"
+        if field_name == "timestamp":
+            return "timestamp"
+        if field_name in meta_names and field_name not in group_names:
+            return "meta[{!r}]".format(field_name)
+        return "groups[{!r}]".format(field_name)
+
+    translated = translate_format_string(format_string, field_source)
+    if translated is None:
+
+        def fallback(groups, meta, timestamp):
+            return format_string.format(
+                **{**meta, **groups, "timestamp": timestamp, "name": name}
+            )
 
-    return regex.groupindex.keys()
+        return fallback
+
+    source, namespace = translated
+    namespace["_name"] = name
+    return eval("lambda groups, meta, timestamp: " + source, namespace)
 
 
 def read_config(config_path):
     """Given path to yaml file, return its contents as a dict"""
 
     with open(config_path) as yaml_file:
-        return yaml.load(yaml_file, Loader=yaml.Loader)
+        return yaml.load(yaml_file, Loader=_Loader)
+
+
+CONFIG_CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.join(os.path.expanduser("~"), ".cache")),
+    "collatelogs",
+)
+
+
+def get_config_cache_path(config_path):
+    """Get the path of the JSON cache for the given config file
+
+    The cache path is derived from the config file's path, mtime, and size,
+    so any modification to the config file invalidates its cache"""
+
+    stat = os.stat(config_path)
+    path_hash = hashlib.md5(os.path.abspath(config_path).encode("utf-8")).hexdigest()
+    return os.path.join(
+        CONFIG_CACHE_DIR,
+        "{}-{}-{}.json".format(path_hash, stat.st_mtime_ns, stat.st_size),
+    )
+
+
+def write_config_cache(cache_path, config, validated=False):
+    """Write config to cache_path as JSON. Return True if successful
+
+    The cache is written atomically, so that concurrent invocations never see
+    a partially-written file. Failure to cache is never fatal"""
+
+    try:
+        if not os.path.isdir(CONFIG_CACHE_DIR):
+            os.makedirs(CONFIG_CACHE_DIR)
+        fd, temp_path = tempfile.mkstemp(dir=CONFIG_CACHE_DIR, suffix=".tmp")
+        try:
+            with os.fdopen(fd, "w") as temp_file:
+                json.dump({"config": config, "validated": validated}, temp_file)
+            os.replace(temp_path, cache_path)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+    except (OSError, TypeError, ValueError) as error:
+        logger.debug("Could not write config cache %s: %s", cache_path, error)
+        return False
+
+    logger.debug("Wrote config cache %s", cache_path)
+    return True
+
+
+def prune_config_cache(cache_path):
+    """Remove the caches of previous versions of cache_path's config file"""
+
+    # Cache file names start with the hash of the config file's path
+    path_hash_prefix = os.path.basename(cache_path).split("-", 1)[0] + "-"
+    try:
+        with os.scandir(CONFIG_CACHE_DIR) as entries:
+            for entry in entries:
+                if entry.name.startswith(path_hash_prefix) and entry.path != cache_path:
+                    os.remove(entry.path)
+                    logger.debug("Removed stale config cache %s", entry.path)
+    except OSError as error:
+        logger.debug("Could not prune config caches: %s", error)
+
+
+def read_config_cached(config_path):
+    """Given path to yaml file, return its contents as a dict
+
+    Parsed configs are cached as JSON (which is much faster to load than
+    YAML); the cache is used as long as the config file is unchanged. Return
+    (config, validated), where validated is True if the config has been
+    marked as valid via mark_config_cache_validated"""
+
+    cache_path = get_config_cache_path(config_path)
+    try:
+        with open(cache_path, "rb") as cache_file:
+            cached = json.load(cache_file)
+        return cached["config"], cached["validated"]
+    except (IOError, ValueError, KeyError, TypeError):
+        pass
+
+    config = read_config(config_path)
+    # JSON can't represent everything that YAML can (e.g. non-string keys are
+    # converted to strings), so configs that wouldn't survive the round trip
+    # unchanged aren't cached
+    try:
+        cacheable = json.loads(json.dumps(config)) == config
+    except (TypeError, ValueError):
+        cacheable = False
+    if cacheable:
+        if write_config_cache(cache_path, config):
+            prune_config_cache(cache_path)
+    else:
+        logger.debug("Config %s can't be cached as JSON", config_path)
+    return config, False
+
+
+def mark_config_cache_validated(config_path):
+    """Mark the cached copy of the given config as having passed validation
+
+    Subsequent reads of the (unchanged) config via read_config_cached can
+    then skip validation"""
+
+    try:
+        cache_path = get_config_cache_path(config_path)
+        with open(cache_path, "rb") as cache_file:
+            config = json.load(cache_file)["config"]
+    except (IOError, ValueError, KeyError, TypeError):
+        return False
+
+    return write_config_cache(cache_path, config, validated=True)
 
 
 def match_first(string, prefix_infos, key):
-    """Match string against each regex. Return first match, or None"""
+    """Match string against each regex. Return first match, or None
+
+    The match is returned as (prefix_info, match), where match is the
+    re.Match object; (None, None) is returned if nothing matches"""
 
     for prefix_info in prefix_infos:
         regex = prefix_info.get(key)
-        if regex:
+        if not regex:
+            continue
+        if isinstance(regex, Pattern):
+            # Checking for the regex's literal prefix first is much cheaper
+            # than matching, and rules out most regexes that don't match
+            prefix = literal_prefix(regex)
+            if prefix and not string.startswith(prefix):
+                continue
+            match = regex.match(string)
+        else:
             match = re.match(regex, string)
-            if match:
-                prefix_info["match"] = match.groupdict()
-                return prefix_info
+        if match:
+            return prefix_info, match
+
+    return None, None
+
+
+# The flags that regexes may have and still be combined by combine_regexes,
+# and the letter used to scope each to its branch with an inline flag group,
+# e.g. (?a:...). VERBOSE is not among them, since a trailing comment in one
+# regex would swallow the rest of the combined regex
+INLINE_FLAG_LETTERS = {
+    re.ASCII: "a",
+    re.IGNORECASE: "i",
+    re.MULTILINE: "m",
+    re.DOTALL: "s",
+}
+COMBINABLE_FLAGS = re.ASCII | re.IGNORECASE | re.MULTILINE | re.DOTALL
+
+
+@functools.lru_cache(maxsize=None)
+def combine_regexes(regexes):
+    """Combine the given compiled regexes into a single alternation
+
+    regexes must be a tuple, since results are memoized. Return
+    (combined_regex, branch_groups), where branch_groups[i] is a tuple of
+    (name, group index in combined_regex) for each named group of
+    regexes[i]. Each regex becomes a branch of the alternation, in order, so
+    the branch that matches corresponds to the first regex that would have
+    matched on its own. Each branch keeps its own flags, scoped to it (so,
+    e.g., regexes with and without re.ASCII can be combined).
+
+    Return None if the regexes can't be safely combined: those with flags
+    other than COMBINABLE_FLAGS, numbered backreferences, or conditional
+    groups"""
+
+    branches = []
+    branch_groups = []
+    # Group numbers in the combined regex start at 1
+    group_offset = 1
+    for branch_index, regex in enumerate(regexes):
+        pattern = regex.pattern
+        if not isinstance(pattern, str) or re.search(r"\\\d|\(\?\(", pattern):
+            return None
+
+        # Named groups must be unique across the combined regex, so prefix them
+        prefix = "_{}_".format(branch_index)
+        pattern = re.sub(r"\(\?P<(\w+)>", r"(?P<{}\1>".format(prefix), pattern)
+        pattern = re.sub(r"\(\?P=(\w+)\)", r"(?P={}\1)".format(prefix), pattern)
+        # Make sure that the renaming above didn't misfire (e.g. on something
+        # that only looks like a group, inside of a character class). Group
+        # names aren't part of the parse tree, so renaming them correctly
+        # leaves it unchanged
+        if parse_tree(pattern, regex.flags) != parse_tree(regex.pattern, regex.flags):
+            return None
+        flags = regex.flags & ~re.UNICODE
+        if flags & ~COMBINABLE_FLAGS:
+            return None
+        if flags:
+            pattern = "(?{}:{})".format(
+                "".join(
+                    letter
+                    for flag, letter in INLINE_FLAG_LETTERS.items()
+                    if flags & flag
+                ),
+                pattern,
+            )
+        branches.append("(?P<_branch{}>{})".format(branch_index, pattern))
+        branch_groups.append(
+            tuple(
+                (name, group_offset + index)
+                for name, index in sorted(regex.groupindex.items())
+            )
+        )
+        group_offset += regex.groups + 1
+
+    try:
+        combined_regex = re.compile("|".join(branches))
+    except re.error:
+        return None
+
+    return combined_regex, tuple(branch_groups)
+
+
+def parse_tree(pattern, flags=0):
+    """Return the parse tree of the given pattern, as nested tuples
+
+    Return None if the pattern can't be parsed"""
 
-    return None
+    def to_tuple(value):
+        if isinstance(value, sre_parse.SubPattern):
+            value = value.data
+        if isinstance(value, (list, tuple)):
+            return tuple(to_tuple(item) for item in value)
+        return value
+
+    try:
+        return to_tuple(sre_parse.parse(pattern, flags))
+    except (re.error, TypeError):
+        return None
+
+
+@functools.lru_cache(maxsize=None)
+def literal_prefix(regex):
+    """Return the literal string that every match of the given compiled regex
+    must start with. This is empty if there isn't one (or it can't be
+    determined)"""
+
+    if regex.flags & re.IGNORECASE:
+        return ""
+    try:
+        items = list(sre_parse.parse(regex.pattern, regex.flags))
+    except (re.error, TypeError):
+        return ""
+
+    prefix = []
+    while items:
+        op, av = items[0]
+        if op is sre_parse.LITERAL:
+            prefix.append(chr(av))
+            items = items[1:]
+        elif op is sre_parse.AT:
+            # Anchors (e.g. ^) don't consume anything, so look past them
+            items = items[1:]
+        elif op is sre_parse.SUBPATTERN and not av[1] & re.IGNORECASE:
+            # Look inside of groups; av is (group, add_flags, del_flags, pattern)
+            items = list(av[-1]) + items[1:]
+        else:
+            break
+
+    return "".join(prefix)
+
+
+def leading_literal(regex):
+    """Return the character that every match of the given compiled regex must
+    start with, or None if there isn't one (or it can't be determined)"""
+
+    return literal_prefix(regex)[:1] or None
+
+
+def no_match(string):
+    """A matcher that never matches"""
+
+    return None, None
+
+
+def make_combined_matcher(prefix_infos, key):
+    """Return a function that matches a string against all of the given
+    regexes at once, as a single alternation; None if they can't be combined
+
+    See make_matcher"""
+
+    if not prefix_infos:
+        return no_match
+
+    combined = combine_regexes(tuple(info[key] for info in prefix_infos))
+    if combined is None:
+        return None
+
+    combined_regex, branch_groups = combined
+    # Maps the index of each branch's group to its info and named groups
+    branches = {
+        combined_regex.groupindex["_branch{}".format(branch_index)]: (info, groups)
+        for branch_index, (info, groups) in enumerate(zip(prefix_infos, branch_groups))
+    }
+    combined_match = combined_regex.match
+
+    def matcher(string):
+        match = combined_match(string)
+        if not match:
+            return None, None
+
+        # The branch's group encloses all others, so it always closes last
+        info, groups = branches[match.lastindex]
+        group = match.group
+        return info, {name: group(index) for name, index in groups}
+
+    return matcher
+
+
+def make_matcher(prefix_infos, key):
+    """Return a function that matches a string against each regex in turn
+
+    The function returns (prefix_info, groups), where groups is the
+    groupdict of the first matching regex; (None, None) if nothing matches.
+
+    If possible, the regexes are combined into a single alternation so that
+    each string is matched in a single pass, rather than trying each regex in
+    turn. Otherwise, they are tried in turn, as in match_first.
+
+    Additionally, if the regexes start with different literal characters, a
+    separate alternation is built for each: one containing only the regexes
+    that a string starting with that character could possibly match. Then
+    each string only needs to be matched against those"""
+
+    infos = [info for info in prefix_infos if info.get(key)]
+    matcher = make_combined_matcher(infos, key)
+    if matcher is None:
+        logger.debug("Could not combine %s regexes; matching each in turn", key)
+        # This is the same as match_first, except that each regex's literal
+        # prefix and match method are looked up once, here, rather than for
+        # every string
+        candidates = []
+        for info in infos:
+            regex = info[key]
+            if not isinstance(regex, Pattern):
+                regex = compile_regex(regex)
+            candidates.append((info, literal_prefix(regex), regex.match))
+
+        def matcher(string):
+            for info, prefix, match_regex in candidates:
+                if prefix and not string.startswith(prefix):
+                    continue
+                match = match_regex(string)
+                if match:
+                    return info, match.groupdict()
+            return None, None
+
+        return matcher
+
+    literals = [leading_literal(info[key]) for info in infos]
+    if len(set(literals)) < 2:
+        # Every regex would end up in every bucket; nothing to gain
+        return matcher
+
+    # Regexes without a leading literal could match anything, so they go in
+    # every bucket. Order is preserved, so the first regex that matches is
+    # still the one whose info is returned
+    buckets = {
+        literal: make_combined_matcher(
+            [
+                info
+                for info, info_literal in zip(infos, literals)
+                if info_literal in (literal, None)
+            ],
+            key,
+        )
+        for literal in set(literals) - {None}
+    }
+    default = make_combined_matcher(
+        [info for info, literal in zip(infos, literals) if literal is None], key
+    )
+    if default is None or None in buckets.values():
+        return matcher
+
+    get_bucket = buckets.get
+
+    def bucketed_matcher(string):
+        return get_bucket(string[:1], default)(string)
+
+    return bucketed_matcher
+
+
+@functools.lru_cache(maxsize=None)
+def compile_regex(pattern, flags=0):
+    """Memoized re.compile
+
+    Unlike re's own cache, this is never cleared, so patterns are compiled
+    at most once per process no matter how many times collation is done"""
+
+    return re.compile(pattern, flags)
 
 
 def compile_regexes(prefix_parsing_info):
-    """Compile all regexes in prefix_parsing_info, in place"""
+    """Return a copy of prefix_parsing_info with all of its regexes compiled
 
+    The given dicts are not modified; each is copied. Regexes that have
+    already been compiled are left as they are, unless ascii_only is set and
+    they weren't compiled with re.ASCII.
+
+    If ascii_only is set, line_regex is compiled with re.ASCII: \\d, \\w, \\s,
+    etc. then only match ASCII characters, which is considerably faster"""
+
+    compiled_parsing_info = []
     for info in prefix_parsing_info:
-        info["line_regex"] = re.compile(info["line_regex"])
+        info = dict(info)
+        for key in ("line_regex", "filename_date_regex"):
+            regex = info.get(key, None)
+            if not regex:
+                continue
+            flags = re.ASCII if key == "line_regex" and info.get("ascii_only") else 0
+            if not isinstance(regex, Pattern):
+                info[key] = compile_regex(regex, flags)
+            elif flags and not regex.flags & flags:
+                info[key] = compile_regex(
+                    regex.pattern, regex.flags & ~re.UNICODE | flags
+                )
+        compiled_parsing_info.append(info)
+
+    return compiled_parsing_info
+
+
+@functools.lru_cache(maxsize=64)
+def get_timezone(name):
+    """Return the pytz timezone object for the given name
+
+    Lookups are memoized, since many log_parsing_info entries (and every line
+    parsed by each of them) typically share a small number of zones"""
+
+    from pytz import timezone
+
+    return timezone(name)
+
+
+def get_fixed_utcoffset(tz):
+    """Return the UTC offset of the given time zone if it never changes (e.g.
+    UTC, or Etc/GMT+5), otherwise None
+
+    Zones with DST (or any other historical changes) can only give their
+    offset for a particular datetime, so they return None here"""
+
+    return tz.utcoffset(None)
 
 
+# Many log lines share timestamps, so conversions are memoized
+@functools.lru_cache(maxsize=8192)
 def convert_timezone(dt, tz_from, tz_to):
     """Convert dt from tz_from to tz_to"""
 
@@ -23,7 +23,11 @@ setup(
     packages=["collatelogs"],
     scripts=["bin/collatelogs"],
     include_package_data=True,
-    install_requires=["python-dateutil", "pyyaml", "tqdm", "tzlocal", "pytz"],
+    install_requires=["python-dateutil", "pyyaml", "tzlocal", "pytz"],
+    # Progress bars are only shown if tqdm is installed
+    extras_require={"progress": ["tqdm"]},
+    # f-strings, datetime.fromisoformat, contextlib.nullcontext, etc.
+    python_requires=">=3.7",
     zip_safe=True,
     classifiers=[
         # How mature is this project? Common values are
@@ -38,13 +42,12 @@ setup(
         "License :: OSI Approved :: MIT License",
         # Specify the Python versions you support here. In particular, ensure
         # that you indicate whether you support Python 2, Python 3 or both.
-        "Programming Language :: Python :: 2",
-        "Programming Language :: Python :: 2.6",
-        "Programming Language :: Python :: 2.7",
         "Programming Language :: Python :: 3",
-        "Programming Language :: Python :: 3.2",
-        "Programming Language :: Python :: 3.3",
-        "Programming Language :: Python :: 3.4",
-        "Programming Language :: Python :: 3.5",
+        "Programming Language :: Python :: 3 :: Only",
+        "Programming Language :: Python :: 3.7",
+        "Programming Language :: Python :: 3.8",
+        "Programming Language :: Python :: 3.9",
+        "Programming Language :: Python :: 3.10",
+        "Programming Language :: Python :: 3.11",
     ],
 )
@@ -0,0 +1,215 @@
+import os
+import subprocess
+import sys
+
+import pytest
+
+from collatelogs import logcollator
+from collatelogs.logcollator import LogCollator
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+LOG_PARSING_INFO = [
+    {
+        "name": "default",
+        "line_regex": r"(?P<timestamp>\S+ \S+) (?P<level>\S+) (?P<message>.*)",
+        "timestamp_input_format": "%Y-%m-%d %H:%M:%S",
+    }
+]
+LINE_OUTPUT_FORMAT = "{timestamp} - {filename} - {message}"
+TIMESTAMP_OUTPUT_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+
+def write_logs(directory, num_files, lines_per_file):
+    """Write interleaved log files to directory; return their paths"""
+
+    paths = []
+    for file_index in range(num_files):
+        path = os.path.join(str(directory), "{}.log".format(file_index))
+        with open(path, "w") as log_file:
+            for line_index in range(lines_per_file):
+                seconds = line_index * num_files + file_index
+                log_file.write(
+                    "2020-01-01 {:02d}:{:02d}:{:02d} INFO message {} {}\n".format(
+                        seconds // 3600 % 24,
+                        seconds // 60 % 60,
+                        seconds % 60,
+                        line_index,
+                        "x" * 40,
+                    )
+                )
+        paths.append(path)
+    return paths
+
+
+def make_collator(log_paths, **overrides):
+    kwargs = dict(
+        log_paths=log_paths,
+        line_output_format=LINE_OUTPUT_FORMAT,
+        log_parsing_info=LOG_PARSING_INFO,
+        timestamp_output_format=TIMESTAMP_OUTPUT_FORMAT,
+    )
+    kwargs.update(overrides)
+    return LogCollator(**kwargs)
+
+
+def collate(log_paths, **overrides):
+    return list(make_collator(log_paths, **overrides).collate(show_progress=False))
+
+
+def test_parallel_matches_sequential(tmp_path, monkeypatch):
+    log_paths = write_logs(tmp_path, num_files=3, lines_per_file=100)
+    expected = collate(log_paths, jobs=1)
+    assert len(expected) == 300
+
+    # Force the parallel path, regardless of how little data there is
+    monkeypatch.setattr(logcollator, "PARALLEL_MIN_TOTAL_SIZE", 0)
+    assert logcollator.MP_START_METHOD == "spawn"
+    assert collate(log_paths, jobs=2) == expected
+
+
+@pytest.mark.parametrize(
+    "command",
+    [
+        [sys.executable, os.path.join(REPO_DIR, "bin", "collatelogs")],
+        [sys.executable, "-m", "collatelogs"],
+    ],
+    ids=["script", "module"],
+)
+def test_parallel_cli_under_spawn(tmp_path, command):
+    """Worker processes re-import the main module; it must not run main()"""
+
+    lines_per_file = 30000
+    log_paths = write_logs(tmp_path, num_files=2, lines_per_file=lines_per_file)
+    total_size = sum(os.path.getsize(path) for path in log_paths)
+    assert total_size >= logcollator.PARALLEL_MIN_TOTAL_SIZE
+
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(
+        "line_output_format: '{}'\n"
+        "log_parsing_info:\n"
+        "  - name: '{}'\n"
+        "    line_regex: '{}'\n"
+        "    timestamp_input_format: '{}'\n".format(
+            LINE_OUTPUT_FORMAT,
+            LOG_PARSING_INFO[0]["name"],
+            LOG_PARSING_INFO[0]["line_regex"],
+            LOG_PARSING_INFO[0]["timestamp_input_format"],
+        )
+    )
+    env = dict(os.environ)
+    env["PYTHONPATH"] = os.pathsep.join(
+        filter(None, [REPO_DIR, env.get("PYTHONPATH")])
+    )
+    env["XDG_CACHE_HOME"] = str(tmp_path / "cache")
+    result = subprocess.run(
+        command + ["-c", str(config_path), "-P", "-j", "2"] + log_paths,
+        env=env,
+        stdout=subprocess.PIPE,
+        stderr=subprocess.PIPE,
+        universal_newlines=True,
+        timeout=300,
+    )
+    assert result.returncode == 0, result.stderr
+    assert "BrokenProcessPool" not in result.stderr
+    assert len(result.stdout.splitlines()) == 2 * lines_per_file
+
+
+class Progress(object):
+    """Stands in for a tqdm progress bar"""
+
+    def __init__(self):
+        self.n = 0
+
+    def update(self, n=1):
+        self.n += n
+
+
+@pytest.mark.parametrize("newline", ["\n", "\r\n"], ids=["lf", "crlf"])
+def test_progress_counts_bytes(tmp_path, newline):
+    path = tmp_path / "unicode.log"
+    path.write_bytes(
+        newline.join(
+            "2020-01-01 00:00:{:02d} INFO café ✓ {}".format(index % 60, index)
+            for index in range(2500)
+        ).encode("utf-8")
+    )
+    collator = make_collator([str(path)])
+    progress = Progress()
+    (lines,) = collator.process_log_paths([str(path)], progress=progress)
+    assert len(lines) == 2500
+    assert progress.n == os.path.getsize(str(path))
+
+
+@pytest.mark.skipif(not hasattr(os, "mkfifo"), reason="Requires named pipes")
+def test_collate_pipe(tmp_path):
+    """Pipes report a size of 0, but must still be read"""
+
+    fifo_path = str(tmp_path / "pipe.log")
+    os.mkfifo(fifo_path)
+    child = subprocess.Popen(
+        [
+            sys.executable,
+            "-c",
+            "import sys\n"
+            "with open(sys.argv[1], 'w') as fifo:\n"
+            "    fifo.write('2020-01-01 00:00:01 INFO one\\n')\n",
+            fifo_path,
+        ]
+    )
+    try:
+        assert collate([fifo_path], jobs=2) == [
+            "2020-01-01 00:00:01 - pipe.log - one"
+        ]
+    finally:
+        # If the pipe was never opened for reading, the child is still blocked
+        child.kill()
+        child.wait()
+
+
+def test_latin1_retry(tmp_path, caplog):
+    """Progress and warnings from before a UnicodeDecodeError aren't repeated"""
+
+    path = tmp_path / "latin1.log"
+    lines = [b"bad line"]
+    lines.extend(
+        "2020-01-01 00:00:{:02d} INFO {}".format(index % 60, index).encode("ascii")
+        for index in range(5000)
+    )
+    lines.append("2020-01-01 00:01:00 INFO café".encode("latin1"))
+    path.write_bytes(b"\n".join(lines))
+
+    collator = make_collator([str(path)], bad_line_behavior="warn")
+    progress = Progress()
+    (processed_lines,) = collator.process_log_paths([str(path)], progress=progress)
+    assert len(processed_lines) == 5001
+    assert processed_lines[-1][1] == "2020-01-01 00:01:00 - latin1.log - café"
+    assert progress.n == os.path.getsize(str(path))
+    assert [record.getMessage() for record in caplog.records] == [
+        "No match found; skipped: 'bad line'"
+    ]
+
+
+def test_keep_bad_lines(tmp_path):
+    path = tmp_path / "keep.log"
+    path.write_text(
+        "before any timestamp\n"
+        "2020-01-01 00:00:02 INFO two\n"
+        "continuation of two\n"
+        "2020-01-01 00:00:01 INFO one\n"
+        "[notadate] unparseable\n"
+    )
+    # The second regex leaves its timestamps to dateutil, which fails to parse
+    # the last line's
+    log_parsing_info = LOG_PARSING_INFO + [
+        {"line_regex": r"\[(?P<timestamp>[^\]]+)\] (?P<message>.*)"}
+    ]
+    assert collate(
+        [str(path)], log_parsing_info=log_parsing_info, bad_line_behavior="keep"
+    ) == [
+        "before any timestamp",
+        "2020-01-01 00:00:01 - keep.log - one",
+        "[notadate] unparseable",
+        "2020-01-01 00:00:02 - keep.log - two",
+        "continuation of two",
+    ]
@@ -0,0 +1,160 @@
+"""Check compile_strptime and compile_strftime against datetime itself"""
+
+import random
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+from collatelogs.logcollator import LogCollator, compile_strftime, compile_strptime
+from collatelogs.util import get_fixed_utcoffset
+
+# Formats that compile_strptime and compile_strftime translate themselves, and
+# a few that they defer to datetime for
+TIME_FORMATS = [
+    "%Y-%m-%d %H:%M:%S",
+    "%Y-%m-%dT%H:%M:%S.%f",
+    "%Y-%m-%d %H:%M:%S,%f",
+    "%y%m%d %H%M%S",
+    "%d/%m/%Y %H:%M",
+    "[%H:%M:%S]",
+    "%Y-%m-%d  %H:%M:%S",
+    "%m-%d %H:%M:%S",
+    "100%% %Y.%m",
+    "%Y-%m-%d %H:%M:%S %Z",
+    "%b %d %H:%M:%S",
+    "%Y-%m-%d %I:%M:%S %p",
+]
+NUM_SAMPLES = 2000
+
+
+def random_datetime(rng):
+    # Years before 1000 are zero-padded by strftime on some platforms only
+    start = datetime(1000, 1, 1)
+    return start + timedelta(
+        seconds=rng.randrange(int((datetime(9999, 12, 31) - start).total_seconds())),
+        microseconds=rng.randrange(1000000),
+    )
+
+
+def mutate(rng, timestamp):
+    """Return a variation of timestamp that strptime may or may not accept"""
+
+    choice = rng.randrange(6)
+    if choice == 0:
+        # Drop leading zeros
+        return " ".join(part.lstrip("0") or "0" for part in timestamp.split(" "))
+    if choice == 1:
+        # Vary whitespace
+        return timestamp.replace(" ", " " * rng.randrange(0, 3))
+    if choice == 2 and timestamp:
+        # Replace a character with a random digit, letter, or separator
+        index = rng.randrange(len(timestamp))
+        return (
+            timestamp[:index] + rng.choice("0123456789a :-.") + timestamp[index + 1 :]
+        )
+    if choice == 3 and timestamp:
+        # Drop a character
+        index = rng.randrange(len(timestamp))
+        return timestamp[:index] + timestamp[index + 1 :]
+    if choice == 4:
+        return timestamp.swapcase() + rng.choice(["", " ", "0", "x"])
+    return timestamp
+
+
+def strptime_result(function, timestamp):
+    """Return function(timestamp), or the type of the exception it raised"""
+
+    try:
+        return function(timestamp)
+    except Exception as error:
+        return type(error)
+
+
+@pytest.mark.parametrize("time_format", TIME_FORMATS)
+def test_compile_strptime_matches_strptime(time_format):
+    rng = random.Random(time_format)
+    strptime = compile_strptime(time_format)
+    for _ in range(NUM_SAMPLES):
+        timestamp = random_datetime(rng).strftime(time_format)
+        for candidate in (timestamp, mutate(rng, timestamp)):
+            expected = strptime_result(
+                lambda value: datetime.strptime(value, time_format), candidate
+            )
+            assert strptime_result(strptime, candidate) == expected, candidate
+
+
+@pytest.mark.parametrize("time_format", ["%Y-%m-%d %Y", "%H %H", "%d %", "%m%d%y"])
+def test_compile_strptime_edge_cases(time_format):
+    strptime = compile_strptime(time_format)
+    for timestamp in ["2020-01-02 2020", "01 01", "02 ", "010203", "12312", ""]:
+        expected = strptime_result(
+            lambda value: datetime.strptime(value, time_format), timestamp
+        )
+        assert strptime_result(strptime, timestamp) == expected, timestamp
+
+
+@pytest.mark.parametrize("time_format", TIME_FORMATS + ["%%Y %Y%%", "", "%Y %"])
+@pytest.mark.parametrize("tz", [None, pytz.utc, pytz.timezone("America/New_York")])
+def test_compile_strftime_matches_strftime(time_format, tz):
+    rng = random.Random(time_format)
+    strftime = compile_strftime(time_format)
+    for _ in range(NUM_SAMPLES):
+        dt = random_datetime(rng)
+        if tz is not None:
+            dt = tz.localize(dt)
+        assert strftime(dt) == dt.strftime(time_format)
+
+
+@pytest.mark.parametrize("time_format", TIME_FORMATS[:9])
+def test_formats_are_translated(time_format):
+    """The comparisons above would be trivial if everything fell back"""
+
+    assert compile_strptime(time_format).__name__ != "fallback"
+    assert compile_strftime(time_format).__name__ != "fallback"
+
+
+FIXED_OFFSET_ZONES = ["UTC", "Etc/GMT+5", "Etc/GMT-3"]
+# A zone with DST, which can't be shifted to or from directly
+DST_ZONE = "America/New_York"
+
+
+@pytest.mark.parametrize("output_zone", FIXED_OFFSET_ZONES + [DST_ZONE, None])
+@pytest.mark.parametrize("input_zone", FIXED_OFFSET_ZONES + [DST_ZONE])
+def test_timestamp_time_zones(input_zone, output_zone):
+    """Fixed-offset zones are attached and shifted between directly; that must
+    be equivalent to localize() and astimezone()"""
+
+    assert (get_fixed_utcoffset(pytz.timezone(input_zone)) is None) == (
+        input_zone == DST_ZONE
+    )
+    time_format = "%Y-%m-%d %H:%M:%S"
+    collator = LogCollator(
+        log_paths=[],
+        line_output_format="{timestamp} {message}",
+        log_parsing_info=[
+            {
+                "line_regex": r"(?P<timestamp>\S+ \S+) (?P<message>.*)",
+                "timestamp_input_format": time_format,
+                "timestamp_input_timezone": input_zone,
+                "timestamp_output_timezone": output_zone,
+            }
+        ],
+        timestamp_output_format=time_format,
+    )
+    process_timestamp = collator.log_parsing_info[0]["_process_timestamp"]
+
+    rng = random.Random(f"{input_zone} {output_zone}")
+    for _ in range(NUM_SAMPLES):
+        dt = random_datetime(rng).replace(microsecond=0)
+        if dt.year == 1900:
+            # This is taken to mean that strptime found no year
+            continue
+        expected = pytz.timezone(input_zone).localize(dt)
+        if output_zone:
+            expected = expected.astimezone(pytz.timezone(output_zone))
+        processed = process_timestamp(dt.strftime(time_format))
+        assert processed == expected
+        assert processed.strftime("%Y-%m-%d %H:%M:%S %Z %z") == expected.strftime(
+            "%Y-%m-%d %H:%M:%S %Z %z"
+        )
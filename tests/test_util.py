@@ -0,0 +1,234 @@
+import os
+import random
+import re
+
+import pytest
+
+from collatelogs import util
+from collatelogs.util import (
+    combine_regexes,
+    compile_regexes,
+    literal_prefix,
+    make_matcher,
+    mark_config_cache_validated,
+    match_first,
+    read_config_cached,
+)
+
+
+def test_config_cache(tmp_path, monkeypatch):
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(util, "CONFIG_CACHE_DIR", str(cache_dir))
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text("a: [1, 2]\n")
+
+    assert read_config_cached(str(config_path)) == ({"a": [1, 2]}, False)
+    assert read_config_cached(str(config_path)) == ({"a": [1, 2]}, False)
+    assert mark_config_cache_validated(str(config_path))
+    assert read_config_cached(str(config_path)) == ({"a": [1, 2]}, True)
+
+    # Modifying the config invalidates its cache, which is then replaced
+    config_path.write_text("a: [1, 2, 3]\n")
+    assert read_config_cached(str(config_path)) == ({"a": [1, 2, 3]}, False)
+    assert len(os.listdir(str(cache_dir))) == 1
+
+
+@pytest.mark.parametrize("text", ["1: a\n", "a: {2: b}\n", "a: 2020-01-01\n"])
+def test_config_cache_skips_lossy_configs(tmp_path, monkeypatch, text):
+    """Configs that JSON can't represent exactly are never cached"""
+
+    cache_dir = tmp_path / "cache"
+    monkeypatch.setattr(util, "CONFIG_CACHE_DIR", str(cache_dir))
+    config_path = tmp_path / "config.yaml"
+    config_path.write_text(text)
+
+    expected = util.read_config(str(config_path))
+    for _ in range(2):
+        assert read_config_cached(str(config_path)) == (expected, False)
+    assert not cache_dir.exists() or not os.listdir(str(cache_dir))
+
+
+def test_combine_regexes_with_mixed_flags():
+    """Each regex's flags only apply to its own branch of the combination"""
+
+    infos = compile_regexes(
+        [
+            {"line_regex": r"(?P<word>\w+)!", "ascii_only": True},
+            {"line_regex": r"(?P<word>\w+)\?"},
+            {"line_regex": re.compile(r"(?P<word>shout)\.", re.IGNORECASE)},
+        ]
+    )
+    assert combine_regexes(tuple(info["line_regex"] for info in infos)) is not None
+
+    match = make_matcher(infos, "line_regex")
+    assert match("café!") == (None, None)
+    assert match("cafe!") == (infos[0], {"word": "cafe"})
+    assert match("café?") == (infos[1], {"word": "café"})
+    assert match("SHOUT.") == (infos[2], {"word": "SHOUT"})
+
+
+# Line regexes that overlap in various ways, and can all be combined
+LINE_REGEXES = [
+    r"(?P<timestamp>\S+ \S+) (?P<level>INFO) (?P<message>.*)",
+    r"(?P<timestamp>\S+) (?P<level>\w+) (?P<message>.*)",
+    r"\[(?P<timestamp>[^\]]+)\] (?P<message>.*)",
+    r"\[(?P<timestamp>\d+)\]",
+    r"(?P<timestamp>\d+)(?: (?P<extra>x+))? (?P<message>.*)",
+    r"(?P<timestamp>\w+)-(?P=timestamp) (?P<message>.*)",
+    r"<(?P<timestamp>[^>]*)>(?P<message>.*)$",
+    re.compile(r"LEVEL: (?P<level>[a-z]+)", re.IGNORECASE),
+    re.compile(r"(?P<timestamp>\d\d) (?P<message>.)", re.ASCII | re.DOTALL),
+    r"x|(?P<timestamp>y)z",
+    r"(?:ab|cd)(?P<timestamp>\d*)",
+]
+# Line regexes that can't be combined: a numbered backreference, global inline
+# flags, and a character class that looks like it contains a group
+UNCOMBINABLE_LINE_REGEXES = [
+    r"(?P<timestamp>a+)(b)\2 (?P<message>.*)",
+    r"(?i)level=(?P<level>\w+)",
+    r"[(?P<a>)]+(?P<timestamp>\d+)",
+]
+LINES = [
+    "2020-01-01 00:00:00 INFO started",
+    "2020-01-01T00:00:00 WARN something",
+    "2020-01-01 00:00:00 ERROR went wrong",
+    "[2020-01-01 00:00:00] bracketed",
+    "[12]",
+    "[12] bracketed",
+    "[x] INFO bracketed",
+    "[1] 2 3",
+    "<a> b c",
+    "123 xx with extra",
+    "123 without extra",
+    "foo-foo repeated",
+    "foo-bar not repeated",
+    "aabb numbered",
+    "<ts>angle",
+    "<ts>multi\nline",
+    "_0_12",
+    "(12",
+    "Level=debug",
+    "LEVEL: Debug",
+    "level: debug",
+    "12 \n",
+    "١٢ unicode digits",
+    "x",
+    "yz",
+    "ab12",
+    "cd",
+    "",
+    " leading space",
+]
+
+
+def match_first_reference(infos, string):
+    """The first-match-wins behavior that make_matcher must reproduce"""
+
+    for info in infos:
+        match = info["line_regex"].match(string)
+        if match:
+            return info, match.groupdict()
+    return None, None
+
+
+def check_matcher(infos):
+    matcher = make_matcher(infos, "line_regex")
+    for line in LINES:
+        assert matcher(line) == match_first_reference(infos, line), line
+
+
+def test_make_matcher_matches_first_match_wins():
+    infos = compile_regexes([{"line_regex": regex} for regex in LINE_REGEXES])
+    assert combine_regexes(tuple(info["line_regex"] for info in infos)) is not None
+    # Every contiguous run of regexes, in both orders, so that each regex is
+    # tried both before and after each of the others
+    for start in range(len(infos)):
+        for stop in range(start + 1, len(infos) + 1):
+            check_matcher(infos[start:stop])
+            check_matcher(infos[start:stop][::-1])
+
+
+def test_make_matcher_random_subsets():
+    """Including regexes that can't be combined, and so are tried in turn"""
+
+    rng = random.Random(0)
+    infos = compile_regexes(
+        [
+            {"line_regex": regex}
+            for regex in LINE_REGEXES + UNCOMBINABLE_LINE_REGEXES
+        ]
+    )
+    for _ in range(500):
+        check_matcher(rng.sample(infos, rng.randrange(1, len(infos) + 1)))
+
+
+def test_uncombinable_regexes():
+    patterns = UNCOMBINABLE_LINE_REGEXES + [r"(a)\1", r"(?P<a>a)?(?(a)b|c)"]
+    for pattern in patterns:
+        assert combine_regexes((re.compile(pattern),)) is None, pattern
+    assert combine_regexes((re.compile("a", re.VERBOSE),)) is None
+
+
+@pytest.mark.parametrize(
+    "regex, prefix",
+    [
+        (r"\[(?P<timestamp>[^\]]+)\] (?P<message>.*)", "["),
+        (r"LEVEL: (?P<level>\w+)", "LEVEL: "),
+        (r"^abc", "abc"),
+        (r"\AAB", "AB"),
+        (r"(?:ab)c\d", "abc"),
+        (r"(?P<x>ab)c", "abc"),
+        (r"(?P<a>x)(?P=a)", "x"),
+        (r"ab*c", "a"),
+        (r"ab?c", "a"),
+        (r"a(?=b)", "a"),
+        (r"a{2}b", ""),
+        (r"a|b", ""),
+        (r"(a)?b", ""),
+        (r"(?=x)x", ""),
+        (r"\d+", ""),
+        (r"", ""),
+        (r"(?i)abc", ""),
+        (r"(?i:ab)c", ""),
+        (re.compile(r"abc", re.IGNORECASE), ""),
+    ],
+)
+def test_literal_prefix(regex, prefix):
+    assert literal_prefix(re.compile(regex)) == prefix
+
+
+def test_literal_prefix_is_a_prefix_of_every_match():
+    regexes = [
+        re.compile(regex) for regex in LINE_REGEXES + UNCOMBINABLE_LINE_REGEXES
+    ]
+    for regex in regexes:
+        prefix = literal_prefix(regex)
+        for line in LINES:
+            if regex.match(line):
+                assert line.startswith(prefix), (regex, line)
+
+
+def test_bucketed_matcher():
+    """Regexes are bucketed by leading literal, but still tried in order"""
+
+    infos = compile_regexes(
+        [
+            {"line_regex": r"\[(?P<timestamp>\d+)\] (?P<message>.*)"},
+            {"line_regex": r"(?P<timestamp>\S+) (?P<message>.*)"},
+            {"line_regex": r"\[(?P<timestamp>[^\]]+)\] (?P<message>.*)"},
+            {"line_regex": r"<(?P<timestamp>[^>]+)> (?P<message>.*)"},
+            {"line_regex": r"<<(?P<timestamp>\d+)>> (?P<message>.*)"},
+            {"line_regex": r"T=(?P<timestamp>\d+) (?P<message>.*)"},
+        ]
+    )
+    lines = LINES + ["[12] a", "[ab] a", "[ab]", "<ab> c", "<<12>> c", "<<12>>c"]
+    lines += ["T=12 a", "T=ab a", "=12 a"]
+    for ordered_infos in (infos, infos[::-1], infos[1:], infos[2:]):
+        matcher = make_matcher(ordered_infos, "line_regex")
+        assert matcher.__name__ == "bucketed_matcher"
+        for line in lines:
+            expected = match_first_reference(ordered_infos, line)
+            assert matcher(line) == expected, line
+
+            info, match = match_first(line, ordered_infos, "line_regex")
+            assert (info, match and match.groupdict()) == expected, line